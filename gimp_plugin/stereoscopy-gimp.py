@@ -119,18 +119,12 @@ def create_anaglyph(image, drawable, left, right,
 def create_side_by_side_image(image, drawable, left, right,
 		method, squash, divider):
 
-	def func(images):
-		is_horizontal = method == 0 or method == 1
-
-		if squash:
-			for i in range(len(images)):
-				images[i] = stereoscopy.squash(images[i], is_horizontal)
+	mode = ["cross-eye", "parallel", "over-under", "under-over"][method]
+	pipeline = stereoscopy.Pipeline(mode,
+		squash=bool(squash), divider=int(divider))
 
-		if method == 0 or method == 3:
-			images.reverse()
-
-		return stereoscopy.create_side_by_side_image(images,
-			is_horizontal, int(divider))
+	def func(images):
+		return pipeline.compose(images)[0]
 
 	_create_stereoscopic_image(func, "Side-by-side", (left, right))
 
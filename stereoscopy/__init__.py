@@ -21,17 +21,43 @@
 
 from __future__ import absolute_import, division, print_function
 
-from PIL import Image, ImageChops, ImageMath
+from PIL import Image, ImageChops, ImageMath, ImageOps
 import math
+import itertools
+import collections
+import io
+import os
+import struct
+import zlib
+import mmap
+import re
 
 try:
 	from importlib.util import find_spec
 except:
 	from pkgutil import find_loader as find_spec
 
-if(find_spec("cv2") is not None and find_spec("numpy") is not None):
-	import cv2
-	import numpy
+# numpy and OpenCV are optional and only imported when first used
+_HAS_NUMPY = find_spec("numpy") is not None
+_HAS_CV2 = _HAS_NUMPY and find_spec("cv2") is not None
+numpy = None
+cv2 = None
+
+def _import_numpy():
+	# Import numpy if available and return whether it is.
+	global numpy
+	if numpy is None and _HAS_NUMPY:
+		import numpy
+	return numpy is not None
+
+def _import_cv2():
+	global cv2
+	if cv2 is None:
+		if not _HAS_CV2:
+			raise ImportError(
+				"OpenCV and numpy are required for auto alignment")
+		_import_numpy()
+		import cv2
 
 def to_pixels(value, reference):
 	"""Convert a percentage to pixels.
@@ -51,6 +77,36 @@ def to_pixels(value, reference):
 		pass
 	return int(value)
 
+def _get_orientation(image):
+	try:
+		return image._getexif()[274]
+	except:
+		return None
+
+def _scale_pixels(value, scale):
+	try:
+		if value.endswith("%"):
+			return value
+	except:
+		pass
+	return int(round(int(value)*scale))
+
+def _map_threads(function, items, threads):
+	# Apply a function to each item in a pool of threads, in which Pillow
+	# releases the GIL while decoding and resampling.
+	items = list(items)
+	if threads < 2 or len(items) < 2:
+		return [function(item) for item in items]
+
+	from multiprocessing.pool import ThreadPool
+
+	pool = ThreadPool(min(threads, len(items)))
+	try:
+		return pool.map(function, items)
+	finally:
+		pool.terminate()
+		pool.join()
+
 def fix_orientation(image):
 	"""Fix the orientation of an image using its exif data.
 
@@ -60,11 +116,7 @@ def fix_orientation(image):
 	Returns:
 		The reorientated PIL image.
 	"""
-	try:
-		orientation = image._getexif()[274]
-	except:
-		return image
-
+	orientation = _get_orientation(image)
 	if orientation == 3:
 		return image.transpose(Image.ROTATE_180)
 	elif orientation == 6:
@@ -82,35 +134,19 @@ def _get_rotation_coordinates(matrix, size):
 		ys.append(matrix[1][0]*x + matrix[1][1]*y)
 	return xs, ys
 
-def transform(images, matrices, shrink=False):
-	"""Transform the images.
-
-	The images are transformed by their matrices and either expanded or
-	shruk to the same size.
-
-	Args:
-		images: The PIL images.
-		matrices: The matrices for each image.
-		shrink: Whether the image is shrunk into or expanded around the
-			resulting picture.
-
-	Returns:
-		The transformed images.
-	"""
-	output = []
-
+def _get_transform_data(sizes, matrices, shrink, output_size=None):
 	output_width = 0
 	output_height = 0
 	matrices = list(matrices)
-	for i, image in enumerate(images):
+	for i, size in enumerate(sizes):
 		matrix = []
 		for row in matrices[i]:
 			matrix.append(list(row))
 		matrices[i] = matrix
 
-		aspect_ratio = image.width / image.height
+		aspect_ratio = size[0] / size[1]
 
-		xs, ys = _get_rotation_coordinates(matrix, image.size)
+		xs, ys = _get_rotation_coordinates(matrix, size)
 
 		min_x = min(xs)
 		max_x = max(xs)
@@ -123,8 +159,8 @@ def transform(images, matrices, shrink=False):
 		a, b, h = matrix[0]
 		c, d, k = matrix[1]
 
-		h += min_x+(expanded_width-image.width)/2
-		k += min_y+(expanded_height-image.height)/2
+		h += min_x+(expanded_width-size[0])/2
+		k += min_y+(expanded_height-size[1])/2
 
 		margin_x = abs((d*h-b*k)/(a*d-b*c))
 		margin_y = abs((a*k-c*h)/(a*d-b*c))
@@ -133,9 +169,9 @@ def transform(images, matrices, shrink=False):
 			rotated_aspect_ratio = expanded_width / expanded_height
 
 			if aspect_ratio < 1:
-				total_height = image.width / rotated_aspect_ratio
+				total_height = size[0] / rotated_aspect_ratio
 			else:
-				total_height = image.height
+				total_height = size[1]
 			angle = math.acos(matrix[0][0])
 			height = total_height / (aspect_ratio * abs(math.sin(angle)) +
 				abs(math.cos(angle)))
@@ -172,18 +208,40 @@ def transform(images, matrices, shrink=False):
 	else:
 		output_width = math.ceil(output_width)
 		output_height = math.ceil(output_height)
+	if output_size:
+		output_width, output_height = output_size
 
-	for i, image in enumerate(images):
+	data = []
+	for i, size in enumerate(sizes):
 		matrix = matrices[i]
-		x = (output_width - image.size[0]) / 2
-		y = (output_height - image.size[1]) / 2
+		x = (output_width - size[0]) / 2
+		y = (output_height - size[1]) / 2
 
 		matrix[0][2] -= matrix[0][0] * x + matrix[0][1] * y
 		matrix[1][2] -= matrix[1][0] * x + matrix[1][1] * y
 
-		output.append(image.transform((output_width, output_height),
-			Image.AFFINE, data=matrix[0]+matrix[1], resample=Image.BICUBIC))
-	return output
+		data.append(matrix[0]+matrix[1])
+	return (output_width, output_height), data
+
+def transform(images, matrices, shrink=False):
+	"""Transform the images.
+
+	The images are transformed by their matrices and either expanded or
+	shruk to the same size.
+
+	Args:
+		images: The PIL images.
+		matrices: The matrices for each image.
+		shrink: Whether the image is shrunk into or expanded around the
+			resulting picture.
+
+	Returns:
+		The transformed images.
+	"""
+	size, data = _get_transform_data([image.size for image in images],
+		matrices, shrink)
+	return [image.transform(size, Image.AFFINE, data=image_data,
+		resample=Image.BICUBIC) for image, image_data in zip(images, data)]
 
 def xy_and_angle_to_matrix(xy, angle, size):
 	"""Create a 3x3 transformation matrix
@@ -230,39 +288,289 @@ def combine_matrices(matrix1, matrix2):
 	return tuple([tuple([sum(a * b for a, b in zip(m1_row, m2_col))
 		for m2_col in m2_columns]) for m1_row in matrix1])
 
-def find_alignments(images, iterations=20, threshold=1e-10):
+class AlignmentCache:
+	'''A persistent cache of found alignments
+
+	The alignments are stored as files in a directory, keyed by a hash
+	of the downsampled grayscale images and the alignment parameters.
+	When there are more than the maximum amount of entries, the least
+	recently used ones are removed.
+
+	Args:
+		directory: The directory of the cache files.
+		max_entries: The maximum amount of cached alignments.
+	'''
+
+	def __init__(self, directory, max_entries=10000):
+		self.directory = directory
+		self.max_entries = max_entries
+		if not os.path.isdir(directory):
+			try:
+				os.makedirs(directory)
+			except OSError:
+				if not os.path.isdir(directory):
+					raise
+
+	@staticmethod
+	def get_key(arrays, *parameters):
+		'''Create a key from image arrays and parameters.
+
+		Args:
+			arrays: The numpy arrays of the images.
+			parameters: The parameters affecting the alignment.
+
+		Returns:
+			The key as a hex string.
+		'''
+		import hashlib
+
+		key = hashlib.sha1(repr(parameters).encode("utf-8"))
+		for array in arrays:
+			key.update(repr(array.shape).encode("utf-8"))
+			key.update(numpy.ascontiguousarray(array).tobytes())
+		return key.hexdigest()
+
+	def _get_path(self, key):
+		return os.path.join(self.directory, key + ".json")
+
+	def get(self, key):
+		'''Get a cached alignment.
+
+		Args:
+			key: The key of the alignment.
+
+		Returns:
+			The cached value or None if not cached.
+		'''
+		import json
+
+		path = self._get_path(key)
+		try:
+			with open(path, "r") as f:
+				value = json.load(f)
+			os.utime(path, None)
+		except (IOError, OSError, ValueError):
+			return None
+		return value
+
+	def set(self, key, value):
+		'''Cache an alignment.
+
+		Args:
+			key: The key of the alignment.
+			value: A JSON serializable value.
+		'''
+		import json
+		import threading
+
+		path = self._get_path(key)
+		temp_path = "{}.{}.{}.tmp".format(path, os.getpid(),
+			threading.current_thread().ident)
+		with open(temp_path, "w") as f:
+			json.dump(value, f)
+		try:
+			os.rename(temp_path, path)
+		except OSError:
+			os.remove(temp_path)
+			return
+		self._evict()
+
+	def _evict(self):
+		paths = [os.path.join(self.directory, name)
+			for name in os.listdir(self.directory) if name.endswith(".json")]
+		if len(paths) <= self.max_entries:
+			return
+
+		entries = []
+		for path in paths:
+			try:
+				entries.append((os.path.getmtime(path), path))
+			except OSError:
+				pass
+		entries.sort()
+		for _, path in entries[:len(entries) - self.max_entries]:
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+
+def _find_transform_ecc(images, m, iterations, threshold):
+	criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT,
+		iterations, threshold)
+
+	try:
+		_, m = cv2.findTransformECC(
+			images[0], images[1], m, cv2.MOTION_EUCLIDEAN, criteria, None, 5)
+	except TypeError:
+		_, m = cv2.findTransformECC(
+			images[0], images[1], m, cv2.MOTION_EUCLIDEAN, criteria)
+	return m
+
+def _find_transform_ecc_pyramid(pyramid, iterations, level_iterations,
+		threshold):
+	m = _find_transform_ecc(pyramid[-1],
+		numpy.eye(2, 3, dtype=numpy.float32), iterations, threshold)
+
+	for level, smaller_level in zip(pyramid[-2::-1], pyramid[:0:-1]):
+		scale = level[0].shape[1] / smaller_level[0].shape[1]
+		m[0,2] *= scale
+		m[1,2] *= scale
+		try:
+			m = _find_transform_ecc(level, m, level_iterations, threshold)
+		except cv2.error:
+			# Keep the alignment of the smaller level
+			pass
+	return m
+
+def _detect_features(image, method, cache):
+	# Keypoint positions and descriptors of an image, which are cached
+	# per image to be reused across runs.
+	import base64
+
+	if cache is not None:
+		key = AlignmentCache.get_key([image], "features", method)
+		value = cache.get(key)
+		if value is not None:
+			points = numpy.array(value["points"],
+				dtype=numpy.float32).reshape(-1, 2)
+			if not len(points):
+				return points, numpy.zeros((0, 32), dtype=numpy.uint8)
+			descriptors = numpy.frombuffer(
+				base64.b64decode(value["descriptors"]), dtype=numpy.uint8)
+			return points, descriptors.reshape(len(points), -1)
+
+	if method == "orb":
+		detector = cv2.ORB_create(5000)
+	elif method == "akaze" and hasattr(cv2, "AKAZE_create"):
+		detector = cv2.AKAZE_create()
+	else:
+		raise ValueError("Unsupported alignment method: " + method)
+
+	keypoints, descriptors = detector.detectAndCompute(image, None)
+	points = numpy.array([keypoint.pt for keypoint in keypoints],
+		dtype=numpy.float32).reshape(-1, 2)
+	if descriptors is None:
+		descriptors = numpy.zeros((0, 32), dtype=numpy.uint8)
+
+	if cache is not None:
+		cache.set(key, {
+			"points": points.tolist(),
+			"descriptors": base64.b64encode(
+				descriptors.tobytes()).decode("ascii")})
+	return points, descriptors
+
+def _find_transform_features(images, method, cache):
+	(points1, descriptors1), (points2, descriptors2) = [
+		_detect_features(image, method, cache) for image in images]
+
+	matches = []
+	if len(points1) >= 2 and len(points2) >= 2:
+		matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+		for pair in matcher.knnMatch(descriptors1, descriptors2, k=2):
+			if len(pair) == 2 and pair[0].distance < 0.75 * pair[1].distance:
+				matches.append(pair[0])
+	if len(matches) < 3:
+		raise ValueError("Not enough matching features to align the images")
+
+	source = points1[[match.queryIdx for match in matches]]
+	destination = points2[[match.trainIdx for match in matches]]
+	a, _ = cv2.estimateAffinePartial2D(source, destination,
+		method=cv2.RANSAC, ransacReprojThreshold=3.0)
+	if a is None:
+		raise ValueError("Not enough matching features to align the images")
+
+	# Only the rotation and translation, as with the euclidean ECC
+	angle = math.atan2(a[1,0], a[0,0])
+	c = math.cos(angle)
+	s = math.sin(angle)
+	return numpy.array(((c, -s, a[0,2]), (s, c, a[1,2])), dtype=numpy.float32)
+
+def find_alignments(images, iterations=20, threshold=1e-10, cache=None,
+		levels=1, level_iterations=5, max_size=500, method="ecc",
+		refine=False):
 	"""Find the alignment between two images.
 
+	The alignment is found on downsized images. With multiple levels, it
+	is found at the smallest level of an image pyramid first and refined
+	with a few iterations at each larger level, up to the maximum size,
+	for a more accurate alignment at a predictable cost.
+
+	The default ecc method uses the OpenCV ECC algorithm. The orb and
+	akaze methods match ORB/AKAZE keypoints of both images instead and
+	estimate the alignment with RANSAC, which is faster and handles
+	larger differences. Their result can be refined by ECC. AKAZE needs
+	an OpenCV build that includes it.
+
 	Args:
 		images: Two PIL images.
 		iterations: The amount of iterations.
 		threshold: The accuracy threshold.
+		cache: An optional AlignmentCache or the directory of one, to
+			only find the alignment of the same images once.
+		levels: The amount of pyramid levels, each level being half the
+			size of the next one.
+		level_iterations: The amount of iterations refining the alignment
+			at each larger level.
+		max_size: The maximum width and height of the largest level.
+		method: The alignment method: ecc, orb or akaze.
+		refine: Whether to refine the alignment of the orb and akaze
+			methods with level_iterations of ECC.
 
 	Returns:
 		The alignment matrix for each image.
 	"""
-	ii = images
-	tn_size = 500
-	ratio = max(images[0].size)/tn_size
+	_import_cv2()
+	images, ratio = _get_alignment_thumbnails(images, max_size)
+	m = _find_transform(images, iterations, threshold, cache,
+		levels, level_iterations, method, refine)
+	return _get_alignment_matrices(m, ratio)
+
+def _get_alignment_thumbnails(images, max_size):
+	size = max(images[0].size)
 
 	images = list(images)
 	for i in range(len(images)):
 		images[i] = images[i].convert("L")
 		#Runs on smaller image for speed
-		images[i].thumbnail((tn_size, tn_size), Image.BILINEAR)
+		images[i].thumbnail((max_size, max_size), Image.BILINEAR)
 		images[i] = numpy.array(images[i])
-
-	criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT,
-		iterations, threshold)
-
-	m = numpy.eye(2, 3, dtype=numpy.float32)
-	try:
-		_, m = cv2.findTransformECC(
-			images[0], images[1], m, cv2.MOTION_EUCLIDEAN, criteria, None, 5)
-	except TypeError:
-		_, m = cv2.findTransformECC(
-			images[0], images[1], m, cv2.MOTION_EUCLIDEAN, criteria)
-
+	return images, size/max(images[0].shape)
+
+def _find_transform(images, iterations=20, threshold=1e-10, cache=None,
+		levels=1, level_iterations=5, method="ecc", refine=False):
+	if cache is not None and not isinstance(cache, AlignmentCache):
+		cache = AlignmentCache(cache)
+
+	m = None
+	if cache is not None:
+		key = AlignmentCache.get_key(images, method, iterations, threshold,
+			levels, level_iterations, refine)
+		value = cache.get(key)
+		if value is not None:
+			m = numpy.array(value, dtype=numpy.float32)
+
+	if m is None and method != "ecc":
+		m = _find_transform_features(images, method, cache)
+		if refine:
+			try:
+				m = _find_transform_ecc(images, m, level_iterations, threshold)
+			except cv2.error:
+				pass
+		if cache is not None:
+			cache.set(key, m.tolist())
+	elif m is None:
+		pyramid = [images]
+		while len(pyramid) < levels and min(pyramid[-1][0].shape) >= 32:
+			pyramid.append([cv2.pyrDown(image) for image in pyramid[-1]])
+
+		m = _find_transform_ecc_pyramid(pyramid,
+			iterations, level_iterations, threshold)
+		if cache is not None:
+			cache.set(key, m.tolist())
+	return m
+
+def _get_alignment_matrices(m, ratio):
+	m = m.copy()
 	m[0,2] *= ratio
 	m[1,2] *= ratio
 
@@ -276,8 +584,81 @@ def find_alignments(images, iterations=20, threshold=1e-10):
 
 	return [l, r]
 
+class SequenceAligner:
+	'''Find the alignments of a sequence of image pairs
+
+	The image pairs of a sequence, such as burst photos or the frames of
+	a video, mostly share the same alignment. The full alignment of
+	*find_alignments* is only found on keyframes. In between, the
+	previous alignment is kept when the downsized images barely changed
+	since they were last aligned, or else refined with a few ECC
+	iterations starting from it.
+
+	Args:
+		keyframe_interval: The amount of image pairs from one keyframe
+			to the next.
+		iterations: The amount of iterations refining the previous
+			alignment.
+		change_threshold: The mean absolute difference (0-255) of the
+			downsized images to the ones last aligned below which the
+			previous alignment is kept.
+		**options: The *find_alignments* options for the keyframes.
+	'''
+
+	def __init__(self, keyframe_interval=30, iterations=3,
+			change_threshold=1.0, **options):
+		self.keyframe_interval = keyframe_interval
+		self.iterations = iterations
+		self.change_threshold = change_threshold
+		self.max_size = options.pop("max_size", 500)
+		self.options = options
+
+		self._m = None
+		self._thumbnails = None
+		self._count = 0
+
+	def _has_changed(self, thumbnails):
+		return any(numpy.mean(cv2.absdiff(thumbnail, previous))
+			>= self.change_threshold
+			for thumbnail, previous in zip(thumbnails, self._thumbnails))
+
+	def find_alignments(self, images):
+		'''Find the alignment between the next two images of the sequence.
+
+		Args:
+			images: Two PIL images.
+
+		Returns:
+			The alignment matrix for each image.
+		'''
+		_import_cv2()
+		thumbnails, ratio = _get_alignment_thumbnails(images, self.max_size)
+
+		m = None
+		if (self._m is not None and self._count < self.keyframe_interval
+				and thumbnails[0].shape == self._thumbnails[0].shape):
+			if not self._has_changed(thumbnails):
+				m = self._m
+			else:
+				try:
+					m = _find_transform_ecc(thumbnails, self._m.copy(),
+						self.iterations, self.options.get("threshold", 1e-10))
+				except cv2.error:
+					pass
+		if m is None:
+			m = _find_transform(thumbnails, **self.options)
+			self._count = 0
+		self._count += 1
+
+		if m is not self._m:
+			self._m = m
+			self._thumbnails = thumbnails
+		return _get_alignment_matrices(m, ratio)
+
 def auto_align(images, xy_adjust=None, angle_adjust=None, shrink=False,
-		iterations=20, threshold=1e-10):
+		iterations=20, threshold=1e-10, cache=None,
+		levels=1, level_iterations=5, max_size=500, method="ecc",
+		refine=False):
 	"""Auto align two images.
 
 	This is a convenience function using the *find_alignments*,
@@ -296,12 +677,20 @@ def auto_align(images, xy_adjust=None, angle_adjust=None, shrink=False,
 			resulting picture.
 		iterations: The amount of iterations.
 		threshold: The accuracy threshold.
+		cache: An optional AlignmentCache or the directory of one.
+		levels: The amount of alignment pyramid levels.
+		level_iterations: The amount of iterations refining the alignment
+			at each larger pyramid level.
+		max_size: The maximum width and height of the largest level.
+		method: The alignment method: ecc, orb or akaze.
+		refine: Whether to refine the orb and akaze alignments by ECC.
 
 	Returns:
 		The auto aligned images.
 	"""
 
-	matrices = find_alignments(images, iterations, threshold)
+	matrices = find_alignments(images, iterations, threshold, cache,
+		levels, level_iterations, max_size, method, refine)
 	if xy_adjust or angle_adjust:
 		if not xy_adjust:
 			xy_adjust = (0, 0)
@@ -319,6 +708,15 @@ def auto_align(images, xy_adjust=None, angle_adjust=None, shrink=False,
 
 	return transform(images, matrices, shrink)
 
+def _get_crop_box(size, box):
+	width, height = size
+	left, top, right, bottom = box
+	return (
+		to_pixels(left, height),
+		to_pixels(top, width),
+		width-to_pixels(right, height),
+		height-to_pixels(bottom, width))
+
 def crop(image, box):
 	"""Crop an image.
 
@@ -330,14 +728,28 @@ def crop(image, box):
 	Return:
 		The cropped PIL image.
 	"""
-	left, top, right, bottom = box
-	return image.crop((
-		to_pixels(left, image.height),
-		to_pixels(top, image.width),
-		image.width-to_pixels(right, image.height),
-		image.height-to_pixels(bottom, image.width)))
+	return image.crop(_get_crop_box(image.size, box))
+
+def _get_resize_geometry(image_size, size, offset):
+	width_ratio = size[0]/image_size[0]
+	height_ratio = size[1]/image_size[1]
 
-def resize(image, size, offset="50%"):
+	offset_crop = None
+	if width_ratio > height_ratio:
+		re_size = (size[0], int(round(image_size[1] * width_ratio)))
+		if size[1]:
+			offset = to_pixels(offset, re_size[1]-size[1])
+			offset_crop = (0, offset, size[0], size[1]+offset)
+	elif width_ratio < height_ratio:
+		re_size = (int(round(image_size[0] * height_ratio)), size[1])
+		if size[0]:
+			offset = to_pixels(offset, re_size[0]-size[0])
+			offset_crop = (offset, 0, size[0]+offset, size[1])
+	else:
+		re_size = (size[0], size[1])
+	return re_size, offset_crop
+
+def resize(image, size, offset="50%", source_size=None):
 	"""Resize an image.
 
 	A size value that is not larger than 0 is calculated automatically
@@ -347,32 +759,102 @@ def resize(image, size, offset="50%"):
 		image: A PIL image.
 		size: The width and height.
 		offset: The offset from the center.
+		source_size: The size to calculate the geometry from instead of
+			the image size, such as the size before a reduced decoding.
 
 	Returns:
 		The resized PIL image.
 	"""
-	width_ratio = size[0]/image.width
-	height_ratio = size[1]/image.height
-
-	offset_crop = None
-	if width_ratio > height_ratio:
-		re_size = (size[0], int(round(image.height * width_ratio)))
-		if size[1]:
-			offset = to_pixels(offset, re_size[1]-size[1])
-			offset_crop = (0, offset, size[0], size[1]+offset)
-	elif width_ratio < height_ratio:
-		re_size = (int(round(image.width * height_ratio)), size[1])
-		if size[0]:
-			offset = to_pixels(offset, re_size[0]-size[0])
-			offset_crop = (offset, 0, size[0]+offset, size[1])
-	else:
-		re_size = (size[0], size[1])
+	re_size, offset_crop = _get_resize_geometry(source_size or image.size,
+		size, offset)
 
 	image = image.resize(re_size, Image.LANCZOS)
 	if offset_crop:
 		image = image.crop(offset_crop)
 	return image
 
+def _resample_affine(image, size, data):
+	a, b, c, d, e, f = data
+	if (b == 0 and d == 0 and a > 0 and e > 0 and c >= 0 and f >= 0 and
+			c + a*size[0] <= image.width and f + e*size[1] <= image.height):
+		return image.resize(size, Image.LANCZOS,
+			box=(c, f, c + a*size[0], f + e*size[1]))
+
+	# The affine transform does not filter for downscaling, so
+	# the image is reduced by the integer part of the scale first.
+	factor = int(math.sqrt(abs(a*e - b*d)))
+	if factor > 1 and hasattr(image, "reduce"):
+		image = image.reduce(factor)
+		data = [value / factor for value in data]
+	return image.transform(size, Image.AFFINE, data=data,
+		resample=Image.BICUBIC)
+
+def _get_fused_data(images, matrices, shrink, box, size, offset,
+		source_size=None, transformed_size=None):
+	if matrices is None:
+		transformed_size = images[0].size
+		data = [(1, 0, 0, 0, 1, 0)]*len(images)
+	else:
+		transformed_size, data = _get_transform_data(
+			[image.size for image in images], matrices, shrink,
+			transformed_size)
+
+	# The crop and resize geometry is found at the source size, such as
+	# the size before a reduced decoding, and scaled to the images
+	source_size = source_size or transformed_size
+	scale = (transformed_size[0] / source_size[0],
+		transformed_size[1] / source_size[1])
+	left, top, right, bottom = _get_crop_box(source_size, box)
+	output_size = (right - left, bottom - top)
+	ratio_x = ratio_y = 1
+	if any(size):
+		re_size, offset_crop = _get_resize_geometry(output_size, size, offset)
+		ratio_x = output_size[0] / re_size[0]
+		ratio_y = output_size[1] / re_size[1]
+		output_size = re_size
+		if offset_crop:
+			left += offset_crop[0] * ratio_x
+			top += offset_crop[1] * ratio_y
+			output_size = (offset_crop[2] - offset_crop[0],
+				offset_crop[3] - offset_crop[1])
+
+	scale_x = ratio_x * scale[0]
+	scale_y = ratio_y * scale[1]
+	left *= scale[0]
+	top *= scale[1]
+	data = [(a*scale_x, b*scale_y, a*left + b*top + c,
+		d*scale_x, e*scale_y, d*left + e*top + f)
+		for a, b, c, d, e, f in data]
+	return output_size, data
+
+def transform_crop_resize(images, matrices=None, shrink=False,
+		box=(0, 0, 0, 0), size=(0, 0), offset="50%"):
+	"""Transform, crop and resize the images in a single resample.
+
+	The output has the geometry of the *transform*, *crop* and *resize*
+	functions applied one after the other, but each image is resampled
+	only once, directly at the output size. Without rotation, the images
+	are resized from the corresponding box of the input images.
+
+	Args:
+		images: The PIL images.
+		matrices: The matrices for each image or None to not transform.
+		shrink: Whether the image is shrunk into or expanded around the
+			resulting picture.
+		box: The amount to crop off each side.
+			The box side order is left, top, right, bottom.
+		size: The width and height. A size value that is not larger
+			than 0 is calculated automatically to preserve the aspect
+			ratio. If both are 0, the images are not resized.
+		offset: The resize offset from the center.
+
+	Returns:
+		The transformed PIL images.
+	"""
+	size, data = _get_fused_data(images, matrices, shrink, box, size, offset)
+	return [_resample_affine(image, size, image_data)
+		for image, image_data in zip(images, data)]
+
 def squash(image, horizontal):
 	"""Squash an image to be half its width or height.
 
@@ -390,7 +872,8 @@ def squash(image, horizontal):
 		new_size = (image.width, int(round(image.height/2)))
 	return image.resize(new_size, Image.ANTIALIAS)
 
-def create_side_by_side_image(images, horizontal=True, divider_width=0):
+def create_side_by_side_image(images, horizontal=True, divider_width=0,
+		divider_color=None):
 	"""Create a side-by-side image from two images.
 
 	Args:
@@ -399,6 +882,9 @@ def create_side_by_side_image(images, horizontal=True, divider_width=0):
 			If to join the images horizontal instead of vertical.
 		divider_width:
 			Width of a divider between the two joined images.
+		divider_color:
+			The color of the divider in the mode of the images. If left
+			omitted, the divider is transparent.
 
 	Returns:
 		The side-by-side PIL image.
@@ -414,12 +900,12 @@ def create_side_by_side_image(images, horizontal=True, divider_width=0):
 		r_left = 0
 		r_top = images[0].height + divider_width
 
-	if divider_width:
+	if divider_width and divider_color is None:
 		mode = "RGBA"
 	else:
 		mode = images[0].mode
 
-	output = Image.new(mode, (width, height))
+	output = Image.new(mode, (width, height), divider_color or 0)
 	output.paste(images[0], (0, 0))
 	output.paste(images[1], (r_left, r_top))
 	return output
@@ -432,6 +918,50 @@ ANAGLYPH_LUMA_REC709 = (0.2126, 0.7152, 0.0722)
 _DEFAULT_AG_CS = "red-cyan"
 _DEFAULT_AG_LUMA = ANAGLYPH_LUMA_REC709
 
+def _get_gamma_curve(gamma):
+	exponent = numpy.float32(1/gamma)
+	def curve(values):
+		return numpy.power(values/numpy.float32(255), exponent)*255
+	return curve
+
+_LEVEL_TABLE_STEPS = 256
+
+def _get_level_table(curve):
+	"""Compile an increasing curve into an output level lookup table.
+
+	The table holds the level at every 1/256 of the input range and the
+	lowest float32 input reaching each following level, found by
+	bisecting the float32 bit patterns. The steps are finer than the
+	levels of the gamma curves, so at most the next level is reached
+	within a step.
+	"""
+	levels = numpy.arange(1, 256, dtype=numpy.float32)
+	low = numpy.zeros(255, dtype=numpy.int64)
+	high = numpy.full(255, numpy.float32(255).view(numpy.int32),
+		dtype=numpy.int64)
+	while (low < high).any():
+		middle = (low + high) // 2
+		values = middle.astype(numpy.int32).view(numpy.float32)
+		reached = curve(values) >= levels
+		high = numpy.where(reached, middle, high)
+		low = numpy.where(reached, low, middle + 1)
+	thresholds = high.astype(numpy.int32).view(numpy.float32)
+
+	steps = numpy.arange(255*_LEVEL_TABLE_STEPS + 1,
+		dtype=numpy.float32) / _LEVEL_TABLE_STEPS
+	step_levels = numpy.searchsorted(
+		thresholds, steps, side="right").astype(numpy.uint8)
+	next_thresholds = numpy.append(
+		thresholds, numpy.float32(numpy.inf)).astype(numpy.float32)
+	return step_levels, next_thresholds
+
+def _apply_level_table(values, table, output):
+	step_levels, next_thresholds = table
+	numpy.clip(values, 0, 255, out=values)
+	output[...] = step_levels.take(
+		(values*_LEVEL_TABLE_STEPS).astype(numpy.uint16))
+	output += values >= next_thresholds.take(output)
+
 class AnaglyphMethod:
 	'''A class that represents an anaglyph method
 
@@ -585,28 +1115,72 @@ class AnaglyphMethod:
 		return obj
 
 	def _process_images_wimmer(self, images):
-		left = images[0].copy()
-		right = images[1].copy()
+		if _import_numpy():
+			return tuple(self._process_image_wimmer_numpy(image)
+				for image in images)
+		return tuple(self._process_image_wimmer_pillow(image)
+			for image in images)
 
-		for i in left.load(), right.load():
-			for y in range(left.height):
-				for x in range(left.width):
-					c = list(i[x, y])
+	_wimmer_lut = None
 
-					if c[0] > c[1] and c[0] > c[1]:
-						c[1] = int(round(c[0]*0.3+c[1]*0.7))
-						c[2] = int(round(c[0]*0.3+c[2]*0.7))
-
-					i[x, y] = tuple(c)
-		return left, right
+	@classmethod
+	def _get_wimmer_lut(cls):
+		# Every red and green/blue combination, computed exactly as the
+		# per-pixel formula: round(red*0.3 + value*0.7)
+		if cls._wimmer_lut is None:
+			red = numpy.arange(256, dtype=numpy.float64).reshape(256, 1)
+			value = numpy.arange(256, dtype=numpy.float64).reshape(1, 256)
+			cls._wimmer_lut = numpy.round(
+				red*0.3 + value*0.7).astype(numpy.uint8).ravel()
+		return cls._wimmer_lut
+
+	def _process_image_wimmer_numpy(self, image):
+		lut = self._get_wimmer_lut()
+		data = numpy.array(image)
+		red = data[..., 0].astype(numpy.uint16) << 8
+		is_red = data[..., 0] > data[..., 1]
+		for band in (2, 1):
+			mixed = lut.take(red | data[..., band])
+			numpy.copyto(data[..., band], mixed, where=is_red)
+		return Image.fromarray(data, image.mode)
+
+	def _process_image_wimmer_pillow(self, image):
+		# Without numpy, halfway values are rounded up instead of being
+		# rounded like the float formula, so may differ by 1.
+		bands = list(image.split())
+		r, g, b = bands[:3]
+		for band_i, band in ((1, g), (2, b)):
+			bands[band_i] = ImageMath.eval(
+				"convert(v + (r > g)*((r*3 + v*7 + 5)/10 - v), 'L')",
+				r=r, g=g, v=band)
+		return Image.merge(image.mode, bands)
+
+	def _get_wimmer_gamma(self, band_i):
+		color = self.colors[self.is_reversed][band_i]
+		if color:
+			return 1 + (0.3 * color)
+		return None
 
 	def _process_expression_wimmer(self, band_i, expression):
-		if self.colors[self.is_reversed][band_i]:
-			return ("((" + expression + "/255)**(1/" +
-				str(1 + (0.3 * self.colors[self.is_reversed][band_i])) +
-				"))*255")
+		gamma = self._get_wimmer_gamma(band_i)
+		if gamma:
+			return ("((" + expression + "/255)**(1/" + str(gamma) + "))*255")
 		return expression
 
+	def _get_wimmer_tables(self):
+		# The gamma correction of each band compiled into lookup tables,
+		# cached per instance.
+		if getattr(self, "_wimmer_tables", None) is None:
+			self._wimmer_tables = []
+			for band_i in range(3):
+				gamma = self._get_wimmer_gamma(band_i)
+				if gamma:
+					table = _get_level_table(_get_gamma_curve(gamma))
+				else:
+					table = None
+				self._wimmer_tables.append(table)
+		return self._wimmer_tables
+
 	@classmethod
 	def dubois(cls, color_scheme=_DEFAULT_AG_CS):
 		'''The dubois anaglyph method
@@ -647,7 +1221,8 @@ class AnaglyphMethod:
 		and blue. It takes and returns the image expression used to
 		create the anaglyph image. This expression is used by the Pillow
 		PIL.ImageMath.eval method and its syntax is explained in its
-		documentation.
+		documentation. When not overridden, the anaglyph is created
+		directly from the matrices using numpy if available.
 
 		Args:
 			band_i:
@@ -670,6 +1245,13 @@ class AnaglyphMethod:
 		'''
 		left, right = self.process_images(images)
 
+		if _import_numpy():
+			if self._is_linear():
+				return self._create_anaglyph_numpy(left, right)
+			elif self.process_expression == self._process_expression_wimmer:
+				return self._create_anaglyph_numpy(left, right,
+					self._get_wimmer_tables())
+
 		left_bands = left.split()
 		right_bands = right.split()
 		output_bands = list()
@@ -692,6 +1274,62 @@ class AnaglyphMethod:
 			return Image.merge("RGBA", output_bands)
 		return Image.merge("RGB", output_bands)
 
+	def _is_linear(self):
+		# The output bands are only a mix of the input bands by the
+		# matrices if the expressions are left unprocessed.
+		# The hook may also be replaced by a plain function on the instance
+		return (getattr(self.process_expression, "__func__", None) is
+			getattr(AnaglyphMethod.process_expression, "__func__",
+				AnaglyphMethod.process_expression))
+
+	def _create_anaglyph_numpy(self, left, right, band_tables=None):
+		# Same float32 arithmetic and term order as the expressions,
+		# using a single band sized buffer for the terms. Bands with a
+		# level table are mapped to the output levels through it.
+		has_alpha = len(left.getbands()) > 3 and len(right.getbands()) > 3
+		data = (numpy.asarray(left), numpy.asarray(right))
+		height, width = data[0].shape[:2]
+
+		output = numpy.empty((height, width, 4 if has_alpha else 3),
+			dtype=numpy.uint8)
+		band = numpy.empty((height, width), dtype=numpy.float32)
+		term = numpy.empty_like(band)
+		for i in range(3):
+			terms = [(eye[..., j], matrix[i][j])
+				for eye, matrix in zip(data, self.matrices)
+				for j in range(3)]
+
+			band[...] = terms[0][0]
+			band *= terms[0][1]
+			for values, factor in terms[1:]:
+				term[...] = values
+				term *= factor
+				band += term
+
+			if band_tables and band_tables[i] is not None:
+				_apply_level_table(band, band_tables[i], output[..., i])
+			else:
+				numpy.clip(band, 0, 255, out=band)
+				output[..., i] = band
+
+		if has_alpha:
+			numpy.maximum(data[0][..., 3], data[1][..., 3],
+				out=output[..., 3])
+			return Image.fromarray(output, "RGBA")
+		return Image.fromarray(output, "RGB")
+
+def _get_anaglyph_method(method, color_scheme, luma_coding):
+	if method == "gray":
+		return AnaglyphMethod.gray(color_scheme, luma_coding)
+	elif method == "color":
+		return AnaglyphMethod.color(color_scheme)
+	elif method == "half-color":
+		return AnaglyphMethod.halfColor(color_scheme, luma_coding)
+	elif method == "wimmer":
+		return AnaglyphMethod.wimmer(color_scheme)
+	elif method == "dubois":
+		return AnaglyphMethod.dubois(color_scheme)
+
 def create_anaglyph(images, method="wimmer",
 		color_scheme=_DEFAULT_AG_CS, luma_coding=_DEFAULT_AG_LUMA):
 	"""Create an anaglyph image from two images.
@@ -714,23 +1352,56 @@ def create_anaglyph(images, method="wimmer",
 	Returns:
 		The anaglyph PIL image.
 	"""
-	if method == "gray":
-		am = AnaglyphMethod.gray(color_scheme, luma_coding)
-	elif method == "color":
-		am = AnaglyphMethod.color(color_scheme)
-	elif method == "half-color":
-		am = AnaglyphMethod.halfColor(color_scheme, luma_coding)
-	elif method == "wimmer":
-		am = AnaglyphMethod.wimmer(color_scheme)
-	elif method == "dubois":
-		am = AnaglyphMethod.dubois(color_scheme)
-
-	return am.createAnaglyph(images)
+	return _get_anaglyph_method(
+		method, color_scheme, luma_coding).createAnaglyph(images)
 
 PATTERN_CHECKERBOARD = 0
 PATTERN_INTERLACED_H = 1
 PATTERN_INTERLACED_V = 2
 
+_PATTERNS = {
+	"interlaced-h": PATTERN_INTERLACED_H,
+	"interlaced-v": PATTERN_INTERLACED_V,
+	"checkerboard": PATTERN_CHECKERBOARD
+}
+
+_pattern_masks = collections.OrderedDict()
+
+def _get_line_mask(length, width, left_is_even):
+	two_width = width * 2
+	return bytes(bytearray(
+		0 if ((i % two_width) < width) == left_is_even else 255
+		for i in range(length)))
+
+def _get_pattern_mask(size, pattern, width, left_is_even):
+	key = (size, pattern, width, left_is_even)
+	mask = _pattern_masks.pop(key, None)
+	if mask is not None:
+		_pattern_masks[key] = mask
+		return mask
+
+	if pattern == PATTERN_INTERLACED_H:
+		mask = Image.frombytes("L", (1, size[1]),
+			_get_line_mask(size[1], width, left_is_even)).resize(
+				size, Image.NEAREST)
+	elif pattern == PATTERN_INTERLACED_V:
+		mask = Image.frombytes("L", (size[0], 1),
+			_get_line_mask(size[0], width, left_is_even)).resize(
+				size, Image.NEAREST)
+	elif pattern == PATTERN_CHECKERBOARD:
+		rows = Image.frombytes("L", (1, size[1]),
+			_get_line_mask(size[1], width, True)).resize(size, Image.NEAREST)
+		columns = Image.frombytes("L", (size[0], 1),
+			_get_line_mask(size[0], width, left_is_even)).resize(
+				size, Image.NEAREST)
+		mask = ImageChops.difference(rows, columns)
+
+	# Only the four most recently used masks are kept
+	if len(_pattern_masks) >= 4:
+		_pattern_masks.popitem(last=False)
+	_pattern_masks[key] = mask
+	return mask
+
 def create_patterned_image(images,
 		pattern=PATTERN_INTERLACED_H, width=1, left_is_even=True):
 	"""Create a patterned image from two images.
@@ -744,47 +1415,1380 @@ def create_patterned_image(images,
 	Returns:
 		The patterned PIL image.
 	"""
-	output = images[0].copy()
-	o = output.load()
-	r = images[1].load()
+	left = images[0]
+	right = images[1]
+	if right.mode != left.mode:
+		right = right.convert(left.mode)
+
+	mask = _get_pattern_mask(left.size, pattern, width, left_is_even)
+	return Image.composite(right, left, mask)
+
+def _get_wiggle_palette(images):
+	# A palette shared by all frames, from an octree quantization of the
+	# frames reduced to about a megapixel in total, with the last color
+	# left for transparency when the frames have alpha.
+	width, height = images[0].size
+	factor = max(1, int(math.ceil(math.sqrt(
+		width * height * len(images) / 1000000))))
+	size = (max(1, width // factor), max(1, height // factor))
+	montage = Image.new("RGB", (size[0], size[1] * len(images)))
+	for i, image in enumerate(images):
+		montage.paste(image.convert("RGB").resize(size, Image.BOX),
+			(0, size[1] * i))
+	colors = 255 if images[0].mode == "RGBA" else 256
+	return montage.quantize(colors, Image.FASTOCTREE)
+
+def _quantize_wiggle_frame(image, palette):
+	# The frame in the P mode with the shared palette, with the pixels
+	# which are more than half transparent set to the transparent color.
+	if image.mode == "L":
+		frame = image.copy()
+		frame.putpalette(bytearray(i for i in range(256) for _ in range(3)))
+		return frame
+	frame = image.convert("RGB").quantize(palette=palette, dither=Image.NONE)
+	if image.mode == "RGBA":
+		frame.paste(255, mask=image.getchannel("A").point(
+			lambda value: 255 if value < 128 else 0))
+	return frame
+
+def _encode_gif_image(image, box):
+	# The image descriptor and LZW data of a region of a P mode frame,
+	# encoded by Pillow and taken from a single frame GIF.
+	output = io.BytesIO()
+	image.crop(box).save(output, format="gif", optimize=False)
+	data = bytearray(output.getvalue())
+
+	position = 13
+	if data[10] & 0x80:
+		position += 3 << ((data[10] & 7) + 1)
+	while data[position] == 0x21:
+		position += 2
+		while data[position]:
+			position += data[position] + 1
+		position += 1
+
+	start = position
+	position += 10
+	if data[start + 9] & 0x80:
+		position += 3 << ((data[start + 9] & 7) + 1)
+	position += 1
+	while data[position]:
+		position += data[position] + 1
+	return (b"\x2c" + struct.pack("<HH", box[0], box[1])
+		+ bytes(data[start + 5:position + 1]))
+
+def _write_wiggle_gif(output_file, frames, palette, duration, delta):
+	# Write the frames in the ping-pong order as a looping GIF, encoding
+	# each frame region once and writing it again for repeated frames.
+	width, height = frames[0].size
+	is_transparent = frames[0].mode == "RGBA"
+	if frames[0].mode == "L":
+		palette_data = bytes(bytearray(i for i in range(256)
+			for _ in range(3)))
+	else:
+		palette_data = bytes(palette.getpalette()[:768])
+	palette_data += b"\x00" * (768 - len(palette_data))
+	frames = [_quantize_wiggle_frame(frame, palette) for frame in frames]
+
+	# The frames to show, each with the region changed from the previous
+	# frame and its delay in 1/100 s, identical frames being merged
+	order = list(range(len(frames))) + list(range(len(frames) - 2, 0, -1))
+	delay = int(duration / 10)
+	shown = []
+	for i in order:
+		box = (0, 0, width, height)
+		if shown and delta and not is_transparent:
+			box = ImageChops.difference(frames[shown[-1][0]],
+				frames[i]).getbbox()
+			if box is None:
+				shown[-1][2] += delay
+				continue
+		shown.append([i, box, delay])
+
+	encoded = {}
+	output_file.write(b"GIF89a" + struct.pack("<HHBBB", width, height,
+		0xF7, 0, 0) + palette_data)
+	output_file.write(b"\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00")
+	for i, box, frame_delay in shown:
+		# Restore the background before transparent frames, otherwise
+		# keep the previous frame under the changed region
+		flags = 0x09 if is_transparent else 0x04
+		output_file.write(b"\x21\xf9\x04" + struct.pack("<BHB",
+			flags, min(frame_delay, 0xFFFF), 255 if is_transparent else 0)
+			+ b"\x00")
+		key = (i, box)
+		if key not in encoded:
+			encoded[key] = _encode_gif_image(frames[i], box)
+		output_file.write(encoded[key])
+	output_file.write(b"\x3b")
+
+_WIGGLE_FORMATS = ("GIF", "PNG", "WEBP")
+
+def save_as_wiggle_image(output_file, images, total_duration=200,
+		format=None, delta=True, quality=95, **options):
+	"""Save multiple images as a looping wiggle animation.
+
+	The images are shown forth and back. For GIF images, all frames are
+	quantised with a single shared palette, each frame is encoded once
+	even when shown twice and, with *delta*, only the region changed
+	from the previous frame is stored. Animated PNG and WebP images are
+	written by Pillow from the same frames.
 
-	is_even = True
-	two_width = width * 2
-	for y in range(output.height):
-		for x in range(output.width):
-			if pattern == PATTERN_INTERLACED_H:
-				is_even = (y % two_width) < width
-			elif pattern == PATTERN_INTERLACED_V:
-				is_even = (x % two_width) < width
-			elif pattern == PATTERN_CHECKERBOARD:
-				is_even = (((y % two_width) < width) ==
-					((x % two_width) < width))
-			if is_even != left_is_even:
-				o[x,y] = r[x,y]
-	return output
+	Args:
+		output_file: The file name or file object of the output.
+		images: Multiple PIL images of the same size and mode.
+		total_duration: The total duration for all the images to be
+			shown before looping.
+		format: The output format: GIF, PNG (APNG) or WebP. If omitted,
+			it is determined from the file name extension. Other formats
+			are written as GIF.
+		delta: Whether to store only the changed regions of GIF frames.
+		quality: The quality of lossy WebP images.
+		options: Further options of the Pillow encoder of APNG and WebP
+			images.
+	"""
+	if format is None and isinstance(output_file, str):
+		format = Image.registered_extensions().get(
+			os.path.splitext(output_file)[1].lower())
+	format = (format or "GIF").upper()
+	if format not in _WIGGLE_FORMATS:
+		format = "GIF"
+	duration = int(round(total_duration/len(images)))
+
+	images = list(images)
+	modes = set(image.mode for image in images)
+	if len(modes) > 1 or modes - set(["L", "RGB", "RGBA"]):
+		mode = "RGB"
+		if any("A" in image.getbands() or "transparency" in image.info
+				for image in images):
+			mode = "RGBA"
+		images = [image.convert(mode) for image in images]
+
+	if format != "GIF":
+		frames = images + images[-2:0:-1]
+		frames[0].save(output_file, format=format, save_all=True, loop=0,
+			duration=duration, append_images=frames[1:], quality=quality,
+			**options)
+		return
+
+	palette = None if images[0].mode == "L" else _get_wiggle_palette(images)
+	if isinstance(output_file, str):
+		with open(output_file, "wb") as f:
+			_write_wiggle_gif(f, images, palette, duration, delta)
+	else:
+		_write_wiggle_gif(output_file, images, palette, duration, delta)
 
 def save_as_wiggle_gif_image(output_file, images, total_duration=200):
 	"""Save multiple images as a wiggle GIF image.
 
+	See *save_as_wiggle_image*.
+
 	Args:
 		output_file: The file name of the output GIF.
 		images: Multiple PIL images.
 		total_duration: The total duration for all the images to be
 			shown before looping.
 	"""
-	images[0].save(output_file, format="gif", save_all=True, loop=0,
-		duration=int(round(total_duration/len(images))),
-		append_images=images[1:] + list(reversed(images[1:-1])))
+	save_as_wiggle_image(output_file, images, total_duration, "GIF")
+
+def _read_jpeg_frames(fp, data):
+	# Split concatenated JPEG images, like the frames of an MPO, reading
+	# the stream sequentially by walking the markers of each image.
+	position = 0
+
+	def fill(length):
+		while len(data) - position < length:
+			chunk = fp.read(65536)
+			if not chunk:
+				return False
+			data.extend(chunk)
+		return True
+
+	while True:
+		start = data.find(b"\xff\xd8", position)
+		while start < 0:
+			position = max(len(data) - 1, 0)
+			if not fill(len(data) - position + 1):
+				return
+			start = data.find(b"\xff\xd8", position)
+		position = start + 2
 
-def _main():
-	import sys
+		while True:
+			if not fill(2):
+				return
+			if data[position] != 0xFF:
+				raise SyntaxError("Invalid JPEG marker")
+			marker = data[position + 1]
+			if marker == 0xFF:
+				position += 1
+			elif marker == 0xD9:
+				position += 2
+				break
+			elif marker == 0x01 or 0xD0 <= marker <= 0xD7:
+				position += 2
+			else:
+				if not fill(4):
+					return
+				position += 2 + (data[position + 2] << 8 | data[position + 3])
+				if marker == 0xDA:
+					# Entropy-coded data up to the next non-restart marker
+					while True:
+						end = data.find(b"\xff", position)
+						while end < 0 or end + 1 >= len(data):
+							searched = end if end >= 0 else len(data)
+							if not fill(len(data) - position + 1):
+								return
+							end = data.find(b"\xff", searched)
+						if (data[end + 1] == 0x00
+								or 0xD0 <= data[end + 1] <= 0xD7):
+							position = end + 2
+						else:
+							position = end
+							break
+
+		frame = bytes(data[start:position])
+		del data[:position]
+		position = 0
+		yield Image.open(io.BytesIO(frame))
+
+def open_frames(fp):
+	"""Open the frames of an MPO or other multi-frame image lazily.
+
+	The frames are opened one at a time while iterating and are decoded
+	when used. The JPEG frames of an MPO are read from the file or stream
+	one after the other, so streams like pipes are not read into memory
+	as a whole.
+
+	Args:
+		fp: A file name or a file object.
+
+	Yields:
+		A PIL image for each frame.
+	"""
+	if isinstance(fp, str):
+		with open(fp, "rb") as f:
+			for frame in open_frames(f):
+				yield frame
+		return
+
+	data = bytearray(fp.read(2))
+	if data == b"\xff\xd8":
+		for frame in _read_jpeg_frames(fp, data):
+			yield frame
+		return
+
+	image = Image.open(io.BytesIO(bytes(data) + fp.read()))
+	for i in range(getattr(image, "n_frames", 1)):
+		image.seek(i)
+		yield image.copy()
+
+def _read_exactly(fp, data, length):
+	while len(data) < length:
+		chunk = fp.read(length - len(data))
+		if not chunk:
+			return None
+		data.extend(chunk)
+	frame = bytes(data[:length])
+	del data[:length]
+	return frame
+
+def _read_line(fp, data):
+	while b"\n" not in data:
+		chunk = fp.read(4096)
+		if not chunk:
+			return None
+		data.extend(chunk)
+	end = data.index(b"\n")
+	line = bytes(data[:end]).decode("ascii")
+	del data[:end + 1]
+	return line
+
+# Lookup tables expanding the video range of 16-235 (Y) and 16-240 (Cb, Cr)
+_Y4M_LIMITED_RANGE_LUTS = (
+	[min(max(int(round((i - 16)*255/219)), 0), 255) for i in range(256)],
+	[min(max(int(round((i - 128)*255/224 + 128)), 0), 255)
+		for i in range(256)])
+
+_Y4M_CHROMA_SIZES = {
+	"420jpeg": (2, 2),
+	"420paldv": (2, 2),
+	"420mpeg2": (2, 2),
+	"420": (2, 2),
+	"422": (2, 1),
+	"444": (1, 1),
+	"mono": None
+}
+
+def _read_y4m_frames(fp, data):
+	header = _read_line(fp, data)
+	if header is None or not header.startswith("YUV4MPEG2"):
+		raise SyntaxError("Invalid Y4M header")
+
+	width = height = None
+	fps = (25, 1)
+	chroma = "420jpeg"
+	is_full_range = False
+	for parameter in header.split()[1:]:
+		tag, value = parameter[0], parameter[1:]
+		if tag == "W":
+			width = int(value)
+		elif tag == "H":
+			height = int(value)
+		elif tag == "F":
+			fps = tuple(int(i) for i in value.split(":"))
+		elif tag == "C":
+			chroma = value
+		elif tag == "X" and value == "COLORRANGE=FULL":
+			is_full_range = True
+	if chroma not in _Y4M_CHROMA_SIZES:
+		raise ValueError("Unsupported Y4M chroma subsampling: " + chroma)
+
+	size = (width, height)
+	sizes = [size]
+	if _Y4M_CHROMA_SIZES[chroma]:
+		x, y = _Y4M_CHROMA_SIZES[chroma]
+		sizes += [((width + x - 1) // x, (height + y - 1) // y)]*2
+
+	while True:
+		line = _read_line(fp, data)
+		if line is None:
+			return
+		if not line.startswith("FRAME"):
+			raise SyntaxError("Invalid Y4M frame header")
+
+		bands = []
+		for band_size in sizes:
+			band_data = _read_exactly(fp, data, band_size[0] * band_size[1])
+			if band_data is None:
+				return
+			band = Image.frombytes("L", band_size, band_data)
+			if band.size != size:
+				band = band.resize(size, Image.BILINEAR)
+			bands.append(band)
+
+		if not is_full_range:
+			bands = [band.point(_Y4M_LIMITED_RANGE_LUTS[i > 0])
+				for i, band in enumerate(bands)]
+
+		if len(bands) == 1:
+			image = bands[0].convert("RGB")
+		else:
+			image = Image.merge("YCbCr", bands).convert("RGB")
+		image.info["fps"] = fps
+		yield image
+
+def _read_raw_frames(fp, data, size):
+	if not size or not all(size):
+		raise ValueError("The frame size is required for raw video")
+	while True:
+		frame = _read_exactly(fp, data, size[0] * size[1] * 3)
+		if frame is None:
+			return
+		yield Image.frombytes("RGB", tuple(size), frame)
+
+def open_video_frames(fp, size=None):
+	"""Open the frames of a video one at a time.
+
+	The video is either a YUV4MPEG2 (Y4M) stream, a raw stream of 8-bit
+	RGB frames of a given size or, for a file name containing a
+	printf-style frame number such as "frame%04d.png" that does not
+	exist itself, a sequence of image files numbered from 0 or 1.
+
+	Args:
+		fp: A file name or a file object.
+		size: The width and height of the frames of a raw stream.
+
+	Yields:
+		A PIL image for each frame.
+	"""
+	if isinstance(fp, str):
+		if re.search(r"%(0\d+)?d", fp) and not os.path.exists(fp):
+			index = 0 if os.path.exists(fp % 0) else 1
+			while os.path.exists(fp % index):
+				yield Image.open(fp % index)
+				index += 1
+			return
+
+		with open(fp, "rb") as f:
+			for frame in open_video_frames(f, size):
+				yield frame
+		return
+
+	data = bytearray(fp.read(9))
+	if data == b"YUV4MPEG2":
+		frames = _read_y4m_frames(fp, data)
+	else:
+		frames = _read_raw_frames(fp, data, size)
+	for frame in frames:
+		yield frame
+
+_PAM_DEPTH_MODES = {"1": "L", "3": "RGB", "4": "RGBA"}
+
+def _parse_pnm_header(data):
+	# The mode, size and pixel data offset of a PGM/PPM or PAM image with
+	# 8-bit samples, or None for other data.
+	header = bytes(data[:1024])
+	if header.startswith(b"P7"):
+		end = header.find(b"ENDHDR\n")
+		if end < 0:
+			return None
+		fields = {}
+		for line in header[3:end].decode("ascii").splitlines():
+			line = line.split("#")[0].split(None, 1)
+			if len(line) == 2:
+				fields[line[0]] = line[1].strip()
+		mode = _PAM_DEPTH_MODES.get(fields.get("DEPTH"))
+		if mode is None or fields.get("MAXVAL") != "255":
+			return None
+		return mode, (int(fields["WIDTH"]), int(fields["HEIGHT"])), end + 7
+
+	match = re.match(br"P([56])(?:\s+(?:#[^\n]*\n\s*)*(\d+)){3}\s", header)
+	if match is None:
+		return None
+	values = re.sub(br"#[^\n]*\n", b" ", header[2:match.end()]).split()
+	if len(values) != 3 or values[2] != b"255":
+		return None
+	return ("L" if match.group(1) == b"5" else "RGB",
+		(int(values[0]), int(values[1])), match.end())
+
+def open_mapped(path, size=None, mode="RGB"):
+	"""Open an uncompressed image file by memory-mapping it.
+
+	PGM/PPM and PAM images with 8-bit samples are detected by their
+	header, other files are read as raw pixel data of a given size and
+	mode, or else opened as usual. L and RGBA pixel data are used in
+	place in the mapping without a copy, other modes are decoded straight
+	from it.
+
+	Args:
+		path: The file name.
+		size: The width and height of raw pixel data.
+		mode: The mode of raw pixel data: L, RGB or RGBA.
+
+	Returns:
+		A PIL image.
+	"""
+	with open(path, "rb") as f:
+		data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+	header = _parse_pnm_header(data)
+	if header is not None:
+		mode, size, offset = header
+	elif size:
+		offset = 0
+	else:
+		data.close()
+		return Image.open(path)
+
+	length = size[0] * size[1] * len(mode)
+	if len(data) < offset + length:
+		raise ValueError("The image data is too short!")
+	return Image.frombuffer(mode, tuple(size),
+		memoryview(data)[offset:offset + length], "raw", mode, 0, 1)
+
+def _write_y4m_frames(fp, frames, fps):
+	size = None
+	for image in frames:
+		if size is None:
+			size = image.size
+			fp.write("YUV4MPEG2 W{} H{} F{}:{} Ip A1:1 C444 "
+				"XCOLORRANGE=FULL\n".format(size[0], size[1], *fps)
+				.encode("ascii"))
+		elif image.size != size:
+			raise ValueError("The video frames are not the same size!")
+
+		fp.write(b"FRAME\n")
+		for band in image.convert("RGB").convert("YCbCr").split():
+			fp.write(band.tobytes())
+
+def _write_raw_frames(fp, frames):
+	for image in frames:
+		fp.write(image.convert("RGB").tobytes())
+
+def _split_side_by_side_image(image):
+	width = image.width // 2
+	return [image.crop((0, 0, width, image.height)),
+		image.crop((width, 0, width*2, image.height))]
+
+def _write_png_chunk(fp, chunk_type, data):
+	fp.write(struct.pack(">I", len(data)))
+	fp.write(chunk_type + data)
+	fp.write(struct.pack(">I", zlib.crc32(chunk_type + data) & 0xffffffff))
+
+_PNG_COLOR_TYPES = {"L": 0, "RGB": 2, "RGBA": 6}
+
+def _write_png_strips(fp, size, strips, compress_level=6):
+	# Write a PNG image strip by strip, compressing the rows as they come,
+	# with the sub filter if numpy is available or else without a filter.
+	compressor = zlib.compressobj(compress_level)
+	mode = None
+	data = b""
+	for strip in strips:
+		if mode is None:
+			mode = strip.mode if strip.mode in _PNG_COLOR_TYPES else "RGBA"
+			fp.write(b"\x89PNG\r\n\x1a\n")
+			_write_png_chunk(fp, b"IHDR", struct.pack(">IIBBBBB",
+				size[0], size[1], 8, _PNG_COLOR_TYPES[mode], 0, 0, 0))
+		if strip.mode != mode:
+			strip = strip.convert(mode)
+
+		bands = len(mode)
+		if _import_numpy():
+			rows = numpy.asarray(strip).reshape(strip.height, -1)
+			filtered = numpy.empty((strip.height, rows.shape[1] + 1),
+				dtype=numpy.uint8)
+			filtered[:,0] = 1
+			filtered[:,1:bands + 1] = rows[:,:bands]
+			numpy.subtract(rows[:,bands:], rows[:,:-bands],
+				out=filtered[:,bands + 1:])
+			raw = filtered.tobytes()
+		else:
+			row_length = strip.width * bands
+			pixels = strip.tobytes()
+			raw = b"".join(b"\x00" + pixels[i:i + row_length]
+				for i in range(0, len(pixels), row_length))
+
+		data += compressor.compress(raw)
+		if len(data) >= 1 << 16:
+			_write_png_chunk(fp, b"IDAT", data)
+			data = b""
+	_write_png_chunk(fp, b"IDAT", data + compressor.flush())
+	_write_png_chunk(fp, b"IEND", b"")
+
+_PAM_TUPLE_TYPES = {"L": "GRAYSCALE", "RGB": "RGB", "RGBA": "RGB_ALPHA"}
+
+def _write_pnm_strips(fp, size, strips, pam=False):
+	# Write a PPM/PGM or PAM image strip by strip.
+	mode = None
+	for strip in strips:
+		if mode is None:
+			if pam:
+				mode = strip.mode if strip.mode in _PAM_TUPLE_TYPES else "RGBA"
+				header = ("P7\nWIDTH {}\nHEIGHT {}\nDEPTH {}\nMAXVAL 255\n"
+					"TUPLTYPE {}\nENDHDR\n").format(size[0], size[1],
+					len(mode), _PAM_TUPLE_TYPES[mode])
+			else:
+				mode = "L" if strip.mode == "L" else "RGB"
+				header = "{}\n{} {}\n255\n".format(
+					"P5" if mode == "L" else "P6", size[0], size[1])
+			fp.write(header.encode("ascii"))
+		if strip.mode != mode:
+			strip = strip.convert(mode)
+		fp.write(strip.tobytes())
+
+# The Pillow encoder options of the output formats for each encode
+# profile, with the options of any other format under None. "small" is
+# the default and optimizes each format, with progressive JPEG images.
+ENCODE_PROFILES = {
+	"fast": {
+		"JPEG": {"optimize": False},
+		"PNG": {"compress_level": 1},
+		"WEBP": {"method": 0},
+		None: {}
+	},
+	"balanced": {
+		"JPEG": {"optimize": True},
+		"PNG": {"compress_level": 6},
+		"WEBP": {"method": 4},
+		None: {}
+	},
+	"small": {
+		"JPEG": {"optimize": True, "progressive": True},
+		"PNG": {"optimize": True},
+		"WEBP": {"method": 6},
+		None: {"optimize": True}
+	}
+}
+
+# The save formats of Pillow not supporting transparency, to which
+# images with alpha are saved in RGB
+_FORMATS_WITHOUT_ALPHA = ("JPEG", "MPO", "EPS", "PCX")
+
+# The output formats written strip by strip with the same data as when
+# saved by Pillow, which are streamed when outputting to a pipe
+_STRIP_FORMATS = ("ppm", "pgm", "pnm", "pam", "raw")
+
+class _ChunkedWriter:
+	'''A file object passing the written data on in chunks
+
+	The data is written to the underlying stream and flushed as soon as
+	a chunk is complete, so a process reading a pipe receives the output
+	while it is still being encoded.
+
+	Args:
+		fp: The underlying file object.
+		chunk_size: The size of the chunks.
+	'''
+
+	def __init__(self, fp, chunk_size=65536):
+		self.fp = fp
+		self.chunk_size = chunk_size
+		self._buffer = bytearray()
+
+	def write(self, data):
+		'''Write data, passing on every complete chunk.
+
+		Args:
+			data: The bytes to write.
+		'''
+		self._buffer.extend(data)
+		if len(self._buffer) >= self.chunk_size:
+			end = len(self._buffer) - len(self._buffer) % self.chunk_size
+			self.fp.write(bytes(self._buffer[:end]))
+			del self._buffer[:end]
+			self.fp.flush()
+		return len(data)
+
+	def flush(self):
+		'''Pass on the remaining data.'''
+		if self._buffer:
+			self.fp.write(bytes(self._buffer))
+			del self._buffer[:]
+		self.fp.flush()
+
+class Pipeline:
+	'''A reusable conversion of image pairs into a stereoscopic image
+
+	This class takes the same options as the command-line interface and
+	combines the preprocessing, the creation of the stereoscopic image
+	and the saving. It is created once and then applied to many image
+	pairs with the *process* and *save* methods. The anaglyph method and
+	the transform matrices without auto alignment are only prepared once.
+
+	The available modes are "cross-eye", "parallel", "over-under",
+	"under-over", "anaglyph", "interlaced-h", "interlaced-v",
+	"checkerboard" and "wiggle".
+
+	Args:
+		mode: The output mode.
+		squash: Whether to squash the sides of side-by-side images.
+		divider: The width of a divider between side-by-side images.
+		split: Whether to output the two sides of side-by-side images
+			as separate images.
+		anaglyph_method: The anaglyph method name.
+		color_scheme: The anaglyph color scheme.
+		luma_coding: The luma coding for the gray and half-color methods.
+		pattern_width: The width of a line/square of patterned images.
+		left_is_even: Set the left image to be the even line/square of
+			patterned images.
+		duration: The total duration of wiggle GIF images.
+		auto_align: Whether to auto align the images.
+		align_cache: An optional AlignmentCache or the directory of one
+			for the auto alignment.
+		align_levels: The amount of auto alignment pyramid levels.
+		align_size: The maximum width and height of the images the
+			auto alignment is found on.
+		align_method: The auto alignment method: ecc, orb or akaze.
+		align_refine: Whether to refine the orb and akaze auto alignments
+			by ECC.
+		align_keyframes: The interval of video frames fully auto aligned
+			with a *SequenceAligner* to realign every frame. If 0, video
+			frames are aligned like the first frame.
+		rotate: The rotation in degrees of each image (left, right).
+		shift: The shift of the right image in relation to the left
+			image (x, y).
+		expand: Whether to expand the images around the aligned/rotated
+			pictures instead of shrinking them into them.
+		crop: The amount to crop off each side (left, top, right, bottom).
+		resize: The width and height to resize to.
+		offset: The resize offset.
+		single_resample: Whether to transform, crop and resize each image
+			in a single resample.
+		draft: Whether to decode JPEG images at a reduced size when
+			resizing to at most half the size.
+		border: The width of a border around the output images.
+		bg_color: The background color (red, green, blue, alpha).
+		format: The output image format.
+		quality: The output image quality.
+		threads: The amount of threads decoding, preprocessing and
+			squashing the images at once. If 1, the images are processed
+			one after the other.
+		encode_profile: The encoder settings of the output formats:
+			"fast", "balanced" or "small". See *ENCODE_PROFILES*.
+		timings: An optional dict to which the time in seconds spent
+			decoding and preparing the input images is added as "decode".
+	'''
+
+	def __init__(self, mode="cross-eye", squash=False, divider=0,
+			split=False, anaglyph_method="wimmer",
+			color_scheme=_DEFAULT_AG_CS, luma_coding=_DEFAULT_AG_LUMA,
+			pattern_width=1, left_is_even=True, duration=300,
+			auto_align=False, align_cache=None, align_levels=1,
+			align_size=500, align_method="ecc", align_refine=False,
+			align_keyframes=0, rotate=(0, 0), shift=(0, 0), expand=False,
+			crop=(0, 0, 0, 0), resize=(0, 0), offset="50%",
+			single_resample=False, draft=False, border=0, bg_color=None,
+			format=None, quality=95, threads=2, encode_profile="small",
+			timings=None):
+		self.mode = mode
+		self.squash = squash
+		self.divider = divider
+		self.split = split
+		self.pattern_width = pattern_width
+		self.left_is_even = left_is_even
+		self.duration = duration
+		self.auto_align = auto_align
+		if align_cache is not None and not isinstance(
+				align_cache, AlignmentCache):
+			align_cache = AlignmentCache(align_cache)
+		self.align_cache = align_cache
+		self.align_levels = align_levels
+		self.align_size = align_size
+		self.align_method = align_method
+		self.align_refine = align_refine
+		self.align_keyframes = align_keyframes
+		self.rotate = tuple(rotate)
+		self.shift = tuple(shift)
+		self.expand = expand
+		self.crop = tuple(crop)
+		self.resize = tuple(resize)
+		self.offset = offset
+		self.single_resample = single_resample
+		self.draft = draft
+		self.border = border
+		self.bg_color = tuple(bg_color) if bg_color else None
+		self.format = format
+		self.quality = quality
+		self.threads = threads
+		if encode_profile not in ENCODE_PROFILES:
+			raise ValueError("Unknown encode profile: " + encode_profile)
+		self.encode_profile = encode_profile
+		self.timings = timings
+
+		if mode == "anaglyph":
+			self.anaglyph_method = _get_anaglyph_method(
+				anaglyph_method, color_scheme, luma_coding)
+		else:
+			self.anaglyph_method = None
+
+		self._fixed_matrices = {}
+
+	def _get_matrices(self, images, shift, aligner=None):
+		key = (images[0].size, images[1].size, shift)
+		if not self.auto_align and key in self._fixed_matrices:
+			return list(self._fixed_matrices[key])
+
+		if self.auto_align and aligner is not None:
+			matrices = aligner.find_alignments(images)
+		elif self.auto_align:
+			matrices = find_alignments(images, cache=self.align_cache,
+				levels=self.align_levels, max_size=self.align_size,
+				method=self.align_method, refine=self.align_refine)
+		else:
+			matrices = [((1, 0, 0), (0, 1, 0), (0, 0, 1))]*2
+
+		for i in range(2):
+			if i == 0:
+				xy = -shift[0], -shift[1]
+			else:
+				xy = shift
+
+			matrix = xy_and_angle_to_matrix(xy, self.rotate[i], images[i].size)
+			matrices[i] = combine_matrices(matrices[i], matrix)
+
+		if not self.auto_align:
+			self._fixed_matrices[key] = tuple(matrices)
+		return matrices
+
+	def _draft(self, images):
+		# The size to decode JPEG images at if the output is at most half
+		# the size, for a decoding at 1/2, 1/4 or 1/8 of their size.
+		size = images[0].size
+		if _get_orientation(images[0]) in (6, 8):
+			size = (size[1], size[0])
+		left, top, right, bottom = _get_crop_box(size, self.crop)
+		cropped_size = (right - left, bottom - top)
+		re_size, _ = _get_resize_geometry(cropped_size, self.resize,
+			self.offset)
+		scale = max(re_size[0]/cropped_size[0], re_size[1]/cropped_size[1])
+		if any(self.shift) or any(self.rotate) or self.auto_align:
+			# Margin for the pictures shrinking by the rotation
+			scale *= 1.25
+		if scale > 0.5:
+			return None
+
+		return (int(math.ceil(images[0].width * scale)),
+			int(math.ceil(images[0].height * scale)))
+
+	def _time(self, name, function, *args):
+		# Call a function, adding the time it takes to the timings if kept
+		if self.timings is None:
+			return function(*args)
+
+		import time
+
+		start = time.time()
+		result = function(*args)
+		self.timings[name] = self.timings.get(name, 0) + time.time() - start
+		return result
+
+	def _needs_alpha(self):
+		# Whether grayscale and palette images are made RGBA, so that a
+		# border or the area around expanded pictures shows a background
+		# which is not opaque instead of black
+		is_expanded = self.expand and (any(self.shift) or any(self.rotate)
+			or self.auto_align)
+		return bool((self.border or is_expanded)
+			and not (self.bg_color and self.bg_color[3] == 255))
+
+	def _needs_color(self):
+		return bool(self.mode == "anaglyph"
+			or self.bg_color and len(set(self.bg_color[:3])) > 1)
+
+	def _load(self, image, draft_size):
+		# Decode and reorient an image, with its size before the draft
+		original_size = image.size
+		if draft_size:
+			image.draft(image.mode, draft_size)
+		image.load()
+		if _get_orientation(image) in (6, 8):
+			original_size = (original_size[1], original_size[0])
+		return fix_orientation(image), original_size
+
+	def _prepare(self, image, draft_size, size=None, mode=None,
+			original_size=None):
+		image, image_size = self._load(image, draft_size)
+		if size and image_size != (original_size or size):
+			raise ValueError("Given images are not the same size!")
+		return self._convert(image, size, mode)
+
+	def _convert(self, image, size=None, mode=None):
+
+		# Keep the narrowest of the L, RGB and RGBA modes, with L images
+		# in RGB among color images, for anaglyphs or a color background
+		if image.mode == "P":
+			image_mode = "RGBA" if "transparency" in image.info else "RGB"
+		elif len(image.getbands()) == 1:
+			image_mode = "L"
+		elif "A" in image.getbands() or "a" in image.getbands():
+			image_mode = "RGBA"
+		else:
+			image_mode = "RGB"
+		if image_mode == "L" and (self._needs_color()
+				or mode not in (None, "L")):
+			image_mode = "RGB"
+		if image.mode not in ("RGB", "RGBA") and self._needs_alpha():
+			image_mode = "RGBA"
+		if image.mode != image_mode:
+			image = image.convert(image_mode)
+
+		if size and image.size != size:
+			# Decoded at another reduced size than the first image, such
+			# as a PNG image among JPEG images
+			image = image.resize(size, Image.LANCZOS)
+		return image
+
+	def _get_resampler(self, images, shift, crop_box, aligner=None,
+			original_size=None, geometry=None):
+		# Returns the resample function and the geometry of the transformed
+		# images, which is kept when given back for the next images of a
+		# sequence, so that only their alignment changes and not the size
+		is_transformed = any(shift) or any(self.rotate) or self.auto_align
+		shrink = not self.expand
+		matrices = (self._get_matrices(images, shift, aligner)
+			if is_transformed else None)
+		sizes = [image.size for image in images]
+
+		# The crop and resize geometry is found at the size of the original
+		# images, so that images decoded at a reduced size give the same
+		# output size
+		if geometry is not None:
+			transformed_size, source_size = geometry
+		else:
+			transformed_size = images[0].size
+			source_size = original_size or images[0].size
+			if matrices is not None:
+				transformed_size, _ = _get_transform_data(sizes, matrices,
+					shrink)
+				scale_x = images[0].width / source_size[0]
+				scale_y = images[0].height / source_size[1]
+				source_size, _ = _get_transform_data(
+					[source_size]*len(images),
+					[((a, b*scale_y/scale_x, h/scale_x),
+					(c*scale_x/scale_y, d, k/scale_y), row)
+					for (a, b, h), (c, d, k), row in matrices], shrink)
+		geometry = (transformed_size, source_size)
+
+		if self.single_resample:
+			if not (is_transformed or any(crop_box) or any(self.resize)):
+				return (lambda image, i: image), geometry
+
+			size, data = _get_fused_data(images, matrices, shrink,
+				self.crop, self.resize, self.offset, source_size,
+				transformed_size)
+			return (lambda image, i: _resample_affine(image, size, data[i]),
+				geometry)
+
+		if is_transformed:
+			size, data = _get_transform_data(sizes, matrices, shrink,
+				transformed_size)
+		left, top, right, bottom = _get_crop_box(source_size, self.crop)
+
+		def resample(image, i):
+			if is_transformed:
+				image = image.transform(size, Image.AFFINE, data=data[i],
+					resample=Image.BICUBIC)
+
+			if any(crop_box):
+				image = crop(image, crop_box)
+
+			if any(self.resize):
+				image = resize(image, self.resize, self.offset,
+					(right - left, bottom - top))
+			return image
+		return resample, geometry
+
+	def preprocess_frames(self, frames):
+		'''Preprocess a sequence of images one at a time.
+
+		The images are reoriented, aligned, transformed, cropped and
+		resized. The geometry is found from the first two images and
+		applied to all following ones, so only the first two images are
+		held at once. The first two images are decoded and resampled at
+		once in threads, see *threads*. With the draft option, JPEG images
+		that have not been loaded yet are decoded at a reduced size.
+
+		Args:
+			frames: An iterable of two or more PIL images of the same
+				size, such as from *open_frames*.
+
+		Yields:
+			The preprocessed PIL images.
+		'''
+		frames = iter(frames)
+		images = list(itertools.islice(frames, 2))
+		draft_size, size, original_size, shift, crop_box = self._setup(images)
+		mode = images[0].mode
+		resample, _ = self._get_resampler(images, shift, crop_box,
+			original_size=original_size)
+		is_resampled = self.threads > 1
+		if is_resampled:
+			images[:] = _map_threads(lambda i: resample(images[i], i),
+				range(len(images)), self.threads)
+
+		for i in range(len(images)):
+			image = images[i]
+			images[i] = None
+			yield image if is_resampled else resample(image, i)
+
+		for image in frames:
+			yield resample(self._time("decode", self._prepare, image,
+				draft_size, size, mode, original_size), 1)
+
+	def _setup(self, images):
+		# Prepare the first images in place and find the geometry applied
+		# to them and all following images.
+		shift = self.shift
+		crop_box = self.crop
+		draft_size = None
+		if self.draft and any(self.resize):
+			draft_size = self._draft(images)
+
+		def prepare(image):
+			return self._load(image, draft_size)
+		images[:] = self._time("decode", _map_threads, prepare, images,
+			self.threads)
+		original_size = images[0][1]
+		if any(image_size != original_size for _, image_size in images):
+			raise ValueError("Given images are not the same size!")
+
+		# JPEG images may be decoded at a reduced size while the others
+		# are not, so all are made the size of the smallest one
+		size = min((image.size for image, _ in images),
+			key=lambda size: size[0]*size[1])
+		if size != original_size:
+			scale = (size[0] / original_size[0], size[1] / original_size[1])
+			shift = (shift[0] * scale[0], shift[1] * scale[1])
+			crop_box = tuple(_scale_pixels(value, scale[i % 2])
+				for i, value in enumerate(crop_box))
+		else:
+			draft_size = None
+		images[:] = self._time("decode", _map_threads,
+			lambda item: self._convert(item[0], size), images, self.threads)
+		if any(image.mode == "L" for image in images) and any(
+				image.mode != "L" for image in images):
+			images[:] = [image.convert("RGB") if image.mode == "L" else image
+				for image in images]
+		return draft_size, size, original_size, shift, crop_box
+
+	def preprocess(self, images):
+		'''Preprocess the images.
+
+		The images are reoriented, aligned, transformed, cropped and
+		resized. See *preprocess_frames*.
+
+		Args:
+			images: Two or more PIL images of the same size.
+
+		Returns:
+			The preprocessed PIL images.
+		'''
+		return list(self.preprocess_frames(images))
+
+	def compose(self, images):
+		'''Create the output images from the preprocessed images.
+
+		Args:
+			images: Two or more preprocessed PIL images.
+
+		Returns:
+			The output PIL images: a single stereoscopic image, the two
+			sides when split or all images for a wiggle image.
+		'''
+		return [self._finish(image) for image in self._compose(images)]
+
+	def _compose(self, images):
+		images = list(images)
+		if self.mode == "anaglyph":
+			images = [self.anaglyph_method.createAnaglyph(images)]
+		elif self.mode in _PATTERNS:
+			images = [create_patterned_image(images,
+				_PATTERNS[self.mode], self.pattern_width, self.left_is_even)]
+		elif self.mode != "wiggle":
+			is_horizontal = self.mode in ("cross-eye", "parallel")
+
+			if self.squash:
+				images = _map_threads(
+					lambda image: squash(image, is_horizontal), images,
+					self.threads)
+
+			if self.mode in ("cross-eye", "under-over"):
+				images.reverse()
+
+			if not self.split:
+				images = [create_side_by_side_image(images, is_horizontal,
+					self.divider, self._get_fill_color(images[0].mode))]
+		return images
+
+	def compose_strips(self, images, tile_height=256):
+		'''Create the output image from the preprocessed images in strips.
+
+		The output image is composed over horizontal strips of the
+		preprocessed images, so the anaglyph, patterned and side-by-side
+		images only need the memory of a strip at a time besides the
+		preprocessed images. Wiggle and split outputs are not supported.
+
+		Args:
+			images: Two preprocessed PIL images.
+			tile_height: The height of the strips. For patterned images,
+				it is rounded down to a multiple of two pattern widths.
+
+		Returns:
+			The size of the output image and an iterator of its strips
+			from top to bottom.
+		'''
+		if self.mode == "wiggle" or self.split:
+			raise ValueError("Wiggle and split outputs are not supported "
+				"in strips!")
+
+		images = list(images)
+		if self.mode == "anaglyph" or self.mode in _PATTERNS:
+			if self.mode in _PATTERNS:
+				period = self.pattern_width * 2
+				tile_height = max(tile_height // period, 1) * period
+			size = images[0].size
+
+			def compose(top, bottom):
+				box = (0, top, size[0], bottom)
+				return self._compose([image.crop(box) for image in images])[0]
+		else:
+			is_horizontal = self.mode in ("cross-eye", "parallel")
+			if self.squash:
+				images = [squash(image, is_horizontal) for image in images]
+			if self.mode in ("cross-eye", "under-over"):
+				images.reverse()
+
+			width, height = images[0].size
+			if is_horizontal:
+				size = (width * 2 + self.divider, height)
+				offsets = ((0, 0), (width + self.divider, 0))
+			else:
+				size = (width, height * 2 + self.divider)
+				offsets = ((0, 0), (0, height + self.divider))
+			color = self._get_fill_color(images[0].mode)
+			if self.divider and color is None:
+				mode = "RGBA"
+			else:
+				mode = images[0].mode
+
+			def compose(top, bottom):
+				strip = Image.new(mode, (size[0], bottom - top), color or 0)
+				for image, (x, y) in zip(images, offsets):
+					box = (0, max(top - y, 0), width, min(bottom - y, height))
+					if box[1] < box[3]:
+						strip.paste(image.crop(box), (x, max(y - top, 0)))
+				return strip
+
+		def strips():
+			for top in range(0, size[1], tile_height):
+				bottom = min(top + tile_height, size[1])
+				yield self._finish(compose(top, bottom), (self.border,
+					self.border if top == 0 else 0, self.border,
+					self.border if bottom == size[1] else 0))
+
+		return (size[0] + self.border * 2, size[1] + self.border * 2), strips()
+
+	def _get_fill_color(self, mode):
+		# The opaque background color for a divider or border of an image
+		# without alpha, which then does not need to be made transparent
+		# for the background to be composited.
+		if mode == "RGBA" or not self.bg_color or self.bg_color[3] != 255:
+			return None
+		return Image.new("RGB", (1, 1), self.bg_color[:3]).convert(
+			mode).getpixel((0, 0))
+
+	def _finish(self, image, border=None):
+		if border is None:
+			border = self.border
+		if border:
+			image = ImageOps.expand(image, border,
+				self._get_fill_color(image.mode) or 0)
+
+		if self.bg_color and image.mode == "RGBA":
+			if self.bg_color[3] == 255:
+				background_image = Image.new("RGB", image.size,
+					self.bg_color[:3])
+				background_image.paste(image, mask=image)
+			else:
+				background_image = Image.new("RGBA", image.size,
+					self.bg_color)
+				background_image.alpha_composite(image)
+			image = background_image
+		return image
+
+	def process(self, images):
+		'''Preprocess the images and create the output images.
+
+		Only the first two images are used, except for wiggle images of
+		which each image is decoded, preprocessed and completed one at a
+		time. The completed wiggle frames are all held, as the encoder
+		needs every frame for the shared palette and the frame durations,
+		so the memory still grows with the amount of frames, only by the
+		size of the output frames instead of the input images.
+
+		Args:
+			images: Two or more PIL images of the same size or an
+				iterable of them, such as from *open_frames*.
+
+		Returns:
+			The output PIL images.
+		'''
+		if self.mode == "wiggle":
+			return [self._finish(image)
+				for image in self.preprocess_frames(images)]
+		return self.compose(self.preprocess(itertools.islice(images, 2)))
+
+	def process_video(self, frames, frames2=None):
+		'''Create the output images of a stereoscopic video frame by frame.
+
+		The geometry, auto alignment, anaglyph method and pattern mask
+		are set up from the first frame pair and reused for all following
+		frames, of which only one pair is held at a time. With
+		*align_keyframes*, every frame pair is realigned with a
+		*SequenceAligner* instead, keeping the output size of the first
+		pair. Wiggle and split outputs are not supported.
+
+		Args:
+			frames: An iterable of the left frames, or of side-by-side
+				frames with the left image on the left when *frames2* is
+				omitted, such as from *open_video_frames*.
+			frames2: An optional iterable of the right frames.
+
+		Yields:
+			The output PIL image of each frame pair.
+		'''
+		if self.mode == "wiggle" or self.split:
+			raise ValueError("Wiggle and split outputs are not supported "
+				"for videos!")
+
+		if frames2 is None:
+			pairs = (_split_side_by_side_image(frame) for frame in frames)
+		else:
+			frames2 = iter(frames2)
+			pairs = ([frame, next(frames2, None)] for frame in frames)
+
+		aligner = None
+		if self.auto_align and self.align_keyframes:
+			aligner = SequenceAligner(self.align_keyframes,
+				cache=self.align_cache, levels=self.align_levels,
+				max_size=self.align_size, method=self.align_method,
+				refine=self.align_refine)
+
+		resample = None
+		geometry = None
+		for images in pairs:
+			if images[1] is None:
+				break
+			if resample is None:
+				draft_size, size, original_size, shift, crop_box = (
+					self._setup(images))
+				mode = images[0].mode
+			else:
+				images = [self._prepare(image, draft_size, size, mode,
+					original_size) for image in images]
+			if resample is None or aligner is not None:
+				resample, geometry = self._get_resampler(images, shift,
+					crop_box, aligner, original_size, geometry)
+			yield self.compose([resample(image, i)
+				for i, image in enumerate(images)])[0]
+
+	def save_video(self, images, output, fps=(25, 1)):
+		'''Save the output images of a video one frame at a time.
+
+		The video format is y4m or raw (8-bit RGB frames), taken from the
+		format or the file extension. For a file name containing a
+		printf-style frame number such as "frame%04d.png", each frame is
+		saved as an image file, numbered from 1.
+
+		Args:
+			images: An iterable of the output PIL images.
+			output: The output file name or file object.
+			fps: The frame rate of a y4m video (numerator, denominator).
+		'''
+		if isinstance(output, str) and re.search(r"%(0\d+)?d", output):
+			for index, image in enumerate(images, 1):
+				self.save([image], output % index)
+			return
+
+		video_format = self.format
+		if not video_format and isinstance(output, str):
+			video_format = os.path.splitext(output)[1][1:]
+		video_format = (video_format or "").lower()
+		if video_format not in ("y4m", "raw", "rgb"):
+			raise ValueError("Unsupported video format: " + video_format)
+
+		if video_format == "y4m":
+			write = lambda fp: _write_y4m_frames(fp, images, fps)
+		else:
+			write = lambda fp: _write_raw_frames(fp, images)
+
+		if isinstance(output, str):
+			with open(output, "wb") as f:
+				write(f)
+		else:
+			write(output)
+
+	def _get_encoder_options(self, image_format):
+		profile = ENCODE_PROFILES[self.encode_profile]
+		return dict(profile.get(image_format, profile[None]))
+
+	def _get_format(self, output):
+		# The Pillow format name from the format, which may also be a file
+		# extension like "jpg", or from the extension of the output file.
+		extension = self.format
+		if extension is None and isinstance(output, str):
+			extension = os.path.splitext(output)[1][1:]
+		if not extension:
+			return None
+		return Image.registered_extensions().get(
+			"." + extension.lower(), extension.upper())
+
+	def save_strips(self, size, strips, output):
+		'''Save an output image strip by strip.
+
+		Each strip is encoded and written as it comes, so the whole image
+		is never held in memory. The format is png, ppm, pam or raw
+		(8-bit RGB), taken from the format or the file extension.
+
+		Args:
+			size: The size of the output image.
+			strips: An iterable of the strips of the output image from
+				top to bottom, such as from *compose_strips*.
+			output: The output file name or file object.
+		'''
+		image_format = self.format
+		if not image_format and isinstance(output, str):
+			image_format = os.path.splitext(output)[1][1:]
+		image_format = (image_format or "").lower()
+		if image_format == "png":
+			write = lambda fp: _write_png_strips(fp, size, strips,
+				self._get_encoder_options("PNG").get("compress_level", 6))
+		elif image_format in ("ppm", "pgm", "pnm", "pam"):
+			write = lambda fp: _write_pnm_strips(fp, size, strips,
+				image_format == "pam")
+		elif image_format == "raw":
+			write = lambda fp: _write_raw_frames(fp, strips)
+		else:
+			raise ValueError("Unsupported format for strips: " + image_format)
+
+		if isinstance(output, str):
+			with open(output, "wb") as f:
+				write(f)
+		else:
+			write(output)
+
+	def save(self, images, output, output2=None):
+		'''Save the output images.
+
+		Args:
+			images: The output PIL images.
+			output: The output file name or file object.
+			output2: The output file name or file object of the second
+				image when split.
+		'''
+		if self.mode == "wiggle":
+			image_format = self._get_format(output)
+			save_as_wiggle_image(output, images, self.duration, image_format,
+				quality=self.quality,
+				**self._get_encoder_options(image_format))
+			return
+
+		for image, path in zip(images, (output, output2)):
+			if path is None:
+				break
+			image_format = self._get_format(path)
+			if (image_format in _FORMATS_WITHOUT_ALPHA
+					and image.mode not in ("1", "L", "RGB", "CMYK")):
+				image = image.convert("RGB")
+			image.save(path, format=image_format, quality=self.quality,
+				**self._get_encoder_options(image_format))
+
+	def save_outputs(self, images, outputs):
+		'''Preprocess the images once and save several outputs.
+
+		The images are preprocessed with the options of this pipeline,
+		then each output is created from the shared preprocessed images
+		and saved by its own pipeline in a thread of its own. Only the
+		first two images are used, also for wiggle outputs.
+
+		Args:
+			images: Two or more PIL images of the same size or an
+				iterable of them, such as from *open_frames*.
+			outputs: A list of pairs of a pipeline and an output file
+				name or file object.
+		'''
+		from multiprocessing.pool import ThreadPool
+
+		images = self.preprocess(itertools.islice(images, 2))
+		# Load the images before they are shared between the threads
+		for image in images:
+			image.load()
+
+		def save(output):
+			pipeline, path = output
+			output_images = images
+			if pipeline._needs_color() and any(
+					image.mode == "L" for image in images):
+				output_images = [image.convert("RGB") for image in images]
+			pipeline.save(pipeline.compose(output_images), path)
+
+		if len(outputs) == 1:
+			save(outputs[0])
+			return
+		pool = ThreadPool(len(outputs))
+		try:
+			pool.map(save, outputs)
+		finally:
+			pool.terminate()
+			pool.join()
+
+def _create_argument_parser():
 	import argparse
-	import io
-	from PIL import ImageOps
 
 	parser = argparse.ArgumentParser(
 		description="Convert 2 images into a stereoscopic 3D image",
-		usage="%(prog)s [OPTION]... [IN] [IN2] [OUT] [OUT2]")
+		usage="%(prog)s [OPTION]... [IN] [IN2] [OUT] [OUT2]\n"
+			"       %(prog)s [OPTION]... --batch TEMPLATE INPUT...")
 
 	parser.add_argument("image_in",
 		metavar="IN", type=str, nargs='?',
@@ -803,6 +2807,8 @@ def _main():
 	parser.add_argument("image_output2",
 		metavar="OUT2", type=str, nargs='?',
 		help="output an optional second image for split left and right")
+	parser.add_argument("batch_inputs",
+		type=str, nargs='*', help=argparse.SUPPRESS)
 
 	parser.add_argument("-q", "--quality",
 		dest='quality', metavar="VALUE", type=int, default="95",
@@ -811,6 +2817,17 @@ def _main():
 		dest='format', metavar="FORMAT", type=str,
 		help="set the output image format: JPG, PNG, GIF,... If left omitted, "
 			"the format to use is determined from the filename extension")
+	parser.add_argument("--encode-profile",
+		dest='encode_profile', metavar="PROFILE", type=str, default="small",
+		choices=sorted(ENCODE_PROFILES),
+		help="set the encoder settings of the output format: fast, balanced "
+			"or small. Fast skips the optimization of JPEG images and "
+			"compresses PNG images the least, small saves progressive JPEG "
+			"images [default: %(default)s]")
+	parser.add_argument("--verbose",
+		dest='verbose', action='store_true',
+		help="print the time spent decoding, processing and encoding "
+			"to STDERR")
 	parser.add_argument("--bg",
 		dest='bg_color', type=int, nargs=4,
 		metavar=("RED", "GREEN", "BLUE", "ALPHA"), default=None,
@@ -819,6 +2836,59 @@ def _main():
 	parser.add_argument("--border",
 		dest='border', metavar="WIDTH", type=int, default=0,
 		help="surround the output image with a border of a given width")
+	parser.add_argument("--output",
+		dest='outputs', metavar="MODE[,OPTION...]:FILE", type=str,
+		action='append',
+		help="add an output file of a given mode, such as anaglyph or "
+			"over-under, with options of the output, such as "
+			"\"over-under,squash,quality=80:tv.jpg\". This can be repeated "
+			"to preprocess the input images once for all outputs, which are "
+			"then created in parallel")
+	parser.add_argument("--raw-size",
+		dest='raw_size', type=int, nargs=2,
+		metavar=("WIDTH", "HEIGHT"), default=None,
+		help="read the input images as raw pixel data of a given size. "
+			"Raw, PGM, PPM and PAM input images are memory-mapped")
+	parser.add_argument("--raw-mode",
+		dest='raw_mode', metavar="MODE", type=str, default="RGB",
+		help="set the mode of raw input images: L, RGB, RGBA "
+			"[default: %(default)s]")
+	parser.add_argument("--tile-height",
+		dest='tile_height', metavar="HEIGHT", type=int, default=0,
+		help="create and write the output image in strips of a given height "
+			"to bound the memory use for very large images. The output "
+			"format must be PNG, PPM, PAM or RAW (8-bit RGB)")
+
+	group = parser.add_argument_group('Video')
+	group.add_argument("--video",
+		dest='video', action='store_true',
+		help="convert a video frame by frame: IN and IN2 are the left and "
+			"right videos, or IN is a side-by-side video with the left image "
+			"on the left when IN2 is omitted, and the last positional "
+			"argument is the output video. Videos are Y4M, raw RGB or image "
+			"sequences named with a frame number like frame%%04d.png. "
+			"Dashes (\"-\") read from STDIN and output to STDOUT")
+	group.add_argument("--video-size",
+		dest='video_size', type=int, nargs=2,
+		metavar=("WIDTH", "HEIGHT"), default=None,
+		help="set the frame size of raw RGB input videos")
+	group.add_argument("--fps",
+		dest='fps', metavar="FPS", type=str, default=None,
+		help="set the frame rate of Y4M output videos, such as 25 or "
+			"30000/1001. If left omitted, the input frame rate or 25 is used")
+
+	group = parser.add_argument_group('Batch')
+	group.add_argument("-b", "--batch",
+		dest='batch', metavar="TEMPLATE", type=str,
+		help="convert every input as an MPO file, reading all files of the "
+			"input directories and glob patterns given as the positional "
+			"arguments. The output files are named by the template in which "
+			"{name} is replaced with the input file name without its "
+			"extension and {dir} with its directory")
+	group.add_argument("-j", "--jobs",
+		dest='jobs', metavar="N", type=int, default=1,
+		help="set the number of processes converting batch inputs in "
+			"parallel, 0 for the number of CPUs [default: %(default)s]")
 
 	group = parser.add_argument_group('Side-by-side')
 	group.add_argument("-x", "--cross-eye",
@@ -868,10 +2938,10 @@ def _main():
 	group = parser.add_argument_group('Animated')
 	group.add_argument("-w", "--wiggle",
 		dest='wiggle', action='store_true',
-		help="output a wiggle GIF image")
+		help="output a wiggle GIF, animated PNG or WebP image")
 	group.add_argument("-t", "--duration",
 		dest='duration', metavar="DURATION", type=int, default=300,
-		help="set the total duration of the wiggle GIF animation "
+		help="set the total duration of the wiggle animation "
 			"in milliseconds [default: %(default)s]")
 
 	group = parser.add_argument_group('Patterned')
@@ -894,11 +2964,38 @@ def _main():
 			"of the pattern [default: %(default)s]")
 
 	group = parser.add_argument_group('Preprocessing')
-	if "cv2" in sys.modules and "numpy" in sys.modules:
+	if _HAS_CV2:
 		group.add_argument("-A", "--auto-align",
 			dest='auto_align', action='store_true',
 			help="auto align the right image to the left image. "
 				"The aspect ratio is preserved")
+		group.add_argument("--align-cache",
+			dest='align_cache', metavar="DIR", type=str,
+			help="cache the found auto alignments in a directory, to only "
+				"align the same images once across multiple runs")
+		group.add_argument("--align-levels",
+			dest='align_levels', metavar="LEVELS", type=int, default=1,
+			help="set the amount of image pyramid levels for the auto "
+				"alignment. It is found at the smallest level and refined at "
+				"each level twice the size [default: %(default)s]")
+		group.add_argument("--align-size",
+			dest='align_size', metavar="SIZE", type=int, default=500,
+			help="set the maximum width and height of the images the auto "
+				"alignment is found on [default: %(default)s]")
+		group.add_argument("--align-method",
+			dest='align_method', metavar="METHOD", type=str, default="ecc",
+			help="set the auto alignment method: ecc, orb, akaze "
+				"[default: %(default)s]. The orb and akaze methods match "
+				"keypoints, which is faster and handles larger differences")
+		group.add_argument("--align-refine",
+			dest='align_refine', action='store_true',
+			help="refine the orb and akaze auto alignments by ecc")
+		group.add_argument("--align-keyframes",
+			dest='align_keyframes', metavar="N", type=int, default=0,
+			help="realign every video frame, fully auto aligning every Nth "
+				"frame and quickly refining or keeping the previous "
+				"alignment in between. If 0, all frames are aligned like the "
+				"first one [default: %(default)s]")
 
 	group.add_argument("-T", "--rotate",
 		dest='rotate', type=float, nargs=2,
@@ -931,133 +3028,548 @@ def _main():
 		dest='offset', type=str, default="50%",
 		help="set the resize offset from top or left "
 			"in either pixels or percentage [default: %(default)s]")
+	group.add_argument("--single-resample",
+		dest='single_resample', action='store_true',
+		help="transform, crop and resize each image in a single resample "
+			"directly at the output size. This is faster and uses less "
+			"memory on large images")
+	group.add_argument("--draft",
+		dest='draft', action='store_true',
+		help="decode JPEG images at 1/2, 1/4 or 1/8 of their size when "
+			"resizing to at most half the size. This is faster and uses "
+			"less memory")
+	group.add_argument("--threads",
+		dest='threads', metavar="N", type=int, default=2,
+		help="set the amount of threads decoding and preprocessing the "
+			"left and right images at once. 1 for none [default: %(default)s]")
+
+	return parser
+
+def _open_image(path, raw_size=None, raw_mode="RGB"):
+	import os
+
+	extension = os.path.splitext(path)[1].lower()
+	if raw_size or extension in (".pgm", ".ppm", ".pnm", ".pam"):
+		return open_mapped(path, raw_size, raw_mode)
+	return Image.open(path)
+
+def _open_images(image_in, image_in2=None, raw_size=None, raw_mode="RGB"):
+	import sys
 
-	args = parser.parse_args()
+	if not image_in2 or image_in2 == "-":
+		if not image_in or image_in == "-":
+			return open_frames(sys.stdin.buffer)
+		return open_frames(image_in)
+	return [_open_image(image_in, raw_size, raw_mode),
+		_open_image(image_in2, raw_size, raw_mode)]
 
-	if args.image_output:
-		image_output = args.image_output
-	else:
-		if args.format is None and not args.wiggle:
-			print("Either specify the output file name or the format "
-				"to be used for outputting to STDOUT.", file=sys.stderr)
-			exit()
-		image_output = sys.stdout.buffer
+_LUMA_CODINGS = {
+	"rgb": ANAGLYPH_LUMA_RGB,
+	"rec601": ANAGLYPH_LUMA_REC601,
+	"rec709": ANAGLYPH_LUMA_REC709
+}
 
-	if not args.image_in2 or args.image_in2 == "-":
-		if not args.image_in or args.image_in == "-":
-			image_in = io.BytesIO(sys.stdin.buffer.read())
-		else:
-			image_in = args.image_in
-		images = []
-		i = 0
-		while True:
-			image = Image.open(image_in)
-			try:
-				image.seek(i)
-			except EOFError:
-				break
-			images.append(image)
-			i += 1
-		del image_in
+def _create_pipeline(args, split=False):
+	if args.anaglyph:
+		mode = "anaglyph"
+	elif args.interlaced_horizontal:
+		mode = "interlaced-h"
+	elif args.interlaced_vertical:
+		mode = "interlaced-v"
+	elif args.checkerboard:
+		mode = "checkerboard"
+	elif args.wiggle:
+		mode = "wiggle"
+	elif args.cross_eye:
+		mode = "cross-eye"
+	elif args.parallel:
+		mode = "parallel"
+	elif args.over_under:
+		mode = "over-under"
+	elif args.under_over:
+		mode = "under-over"
 	else:
-		images = [Image.open(args.image_in), Image.open(args.image_in2)]
+		mode = "cross-eye"
+
+	return Pipeline(mode, squash=args.squash, divider=args.divider,
+		split=split, anaglyph_method=args.anaglyph_method,
+		color_scheme=args.color_scheme,
+		luma_coding=_LUMA_CODINGS.get(args.luma_coding),
+		pattern_width=args.pattern_width, left_is_even=not args.odd,
+		duration=args.duration,
+		auto_align=getattr(args, "auto_align", False),
+		align_cache=getattr(args, "align_cache", None),
+		align_levels=getattr(args, "align_levels", 1),
+		align_size=getattr(args, "align_size", 500),
+		align_method=getattr(args, "align_method", "ecc"),
+		align_refine=getattr(args, "align_refine", False),
+		align_keyframes=getattr(args, "align_keyframes", 0),
+		rotate=args.rotate, shift=args.shift, expand=args.expand,
+		crop=args.crop, resize=args.resize, offset=args.offset,
+		single_resample=args.single_resample, draft=args.draft,
+		border=args.border, bg_color=args.bg_color, format=args.format,
+		quality=args.quality, threads=args.threads,
+		encode_profile=args.encode_profile)
+
+def _get_batch_paths(inputs):
+	import os
+	import glob
+
+	paths = []
+	for pattern in inputs:
+		if os.path.isdir(pattern):
+			paths.extend(sorted(os.path.join(pattern, name)
+				for name in os.listdir(pattern)
+				if os.path.isfile(os.path.join(pattern, name))))
+		else:
+			paths.extend(sorted(glob.glob(pattern)) or [pattern])
+
+	unique_paths = []
+	seen_paths = set()
+	for path in paths:
+		if path not in seen_paths:
+			seen_paths.add(path)
+			unique_paths.append(path)
+	return unique_paths
+
+def _get_batch_output(template, path):
+	import os
+
+	output = template.format(
+		name=os.path.splitext(os.path.basename(path))[0],
+		dir=os.path.dirname(path))
+	directory = os.path.dirname(output)
+	if directory and not os.path.isdir(directory):
+		try:
+			os.makedirs(directory)
+		except OSError:
+			if not os.path.isdir(directory):
+				raise
+	return output
 
-	for i in range(len(images)):
-		images[i] = fix_orientation(images[i])
+_OUTPUT_MODES = {
+	"anaglyph": "anaglyph",
+	"interlaced-h": "interlaced_horizontal",
+	"interlaced-v": "interlaced_vertical",
+	"checkerboard": "checkerboard",
+	"wiggle": "wiggle",
+	"cross-eye": "cross_eye",
+	"parallel": "parallel",
+	"over-under": "over_under",
+	"under-over": "under_over"
+}
+
+# The options which can differ between outputs, not affecting the
+# preprocessing
+_OUTPUT_OPTIONS = ("squash", "divider", "anaglyph_method", "color_scheme",
+	"luma_coding", "pattern_width", "odd", "duration", "border", "bg_color",
+	"format", "quality")
+
+def _parse_output(parser, args, output):
+	# The pipeline and file of an output such as "over-under,squash:tv.jpg",
+	# with the options added to the other arguments.
+	import copy
+
+	spec, _, path = output.partition(":")
+	options = spec.split(",")
+	if not path or options[0] not in _OUTPUT_MODES:
+		parser.error("invalid output: " + output + " (the mode must be one "
+			"of " + ", ".join(sorted(_OUTPUT_MODES)) + ")")
+
+	argv = ["--" + options[0]]
+	for option in options[1:]:
+		key, _, value = option.partition("=")
+		argv.append("--" + key)
+		argv.extend(value.split())
+
+	output_args = copy.copy(args)
+	for dest in _OUTPUT_MODES.values():
+		setattr(output_args, dest, False)
+	output_args = parser.parse_args(argv, output_args)
+	for dest, value in vars(args).items():
+		if (dest not in _OUTPUT_OPTIONS and dest not in ("outputs",
+				"image_in", "image_in2", "image_output", "image_output2",
+				"batch_inputs") and dest not in _OUTPUT_MODES.values()
+				and getattr(output_args, dest) != value):
+			parser.error("invalid output: " + output + " (only the options "
+				"of the output can be set)")
+	return _create_pipeline(output_args), path
+
+def _main_outputs(parser, args):
+	import sys
 
-		if images[i].mode not in ("RGB", "RGBA"):
-			images[i] = images[i].convert("RGBA")
+	if args.image_output or args.batch_inputs:
+		parser.error("OUT cannot be given with --output")
+	outputs = [_parse_output(parser, args, output)
+		for output in args.outputs]
+	pipeline = _create_pipeline(args)
+	images = _open_images(args.image_in, args.image_in2,
+		args.raw_size, args.raw_mode)
+	try:
+		pipeline.save_outputs(images, outputs)
+	except ValueError as e:
+		print(e, file=sys.stderr)
+		exit()
 
-		if i > 0 and images[0].size != images[i].size:
-			print("Given images are not the same size!", file=sys.stderr)
-			exit()
+_batch_pipeline = None
 
-	if any(args.shift) or any(args.rotate) or args.auto_align:
-		if args.auto_align:
-			matrices = find_alignments(images)
-		else:
-			matrices = [((1, 0, 0), (0, 1, 0), (0, 0, 1))]*2
+def _init_batch_worker(args):
+	global _batch_pipeline
+	_batch_pipeline = _create_pipeline(args)
 
-		for i in range(2):
-			if i == 0:
-				xy = -args.shift[0], -args.shift[1]
+def _convert_batch_file(job):
+	template, path = job
+	try:
+		images = _batch_pipeline.process(_open_images(path))
+		_batch_pipeline.save(images, _get_batch_output(template, path))
+	except Exception as e:
+		return path, str(e) or type(e).__name__
+	return path, None
+
+def _main_batch(parser, args):
+	import sys
+	import multiprocessing
+
+	inputs = [i for i in (args.image_in, args.image_in2,
+		args.image_output, args.image_output2) if i] + args.batch_inputs
+	if not inputs:
+		parser.error("no batch inputs given")
+	if "{name}" not in args.batch:
+		parser.error("the batch output template must contain {name}")
+
+	paths = _get_batch_paths(inputs)
+	jobs = [(args.batch, path) for path in paths]
+
+	if args.jobs == 1:
+		_init_batch_worker(args)
+		results = (_convert_batch_file(job) for job in jobs)
+		pool = None
+	else:
+		pool = multiprocessing.Pool(args.jobs or None,
+			_init_batch_worker, (args,))
+		results = pool.imap_unordered(_convert_batch_file, jobs)
+
+	failed = 0
+	try:
+		for done, (path, error) in enumerate(results, 1):
+			if error is None:
+				print("[{}/{}] {}".format(done, len(jobs), path),
+					file=sys.stderr)
 			else:
-				xy = args.shift
+				failed += 1
+				print("[{}/{}] {}: {}".format(done, len(jobs), path, error),
+					file=sys.stderr)
+	finally:
+		if pool is not None:
+			pool.terminate()
+			pool.join()
+
+	print("{} converted, {} failed".format(len(jobs) - failed, failed),
+		file=sys.stderr)
+	if failed:
+		sys.exit(1)
+
+def _main_video(parser, args):
+	import sys
 
-			matrix = xy_and_angle_to_matrix(xy, args.rotate[i], images[i].size)
-			matrices[i] = combine_matrices(matrices[i], matrix)
+	paths = [i for i in (args.image_in, args.image_in2,
+		args.image_output, args.image_output2) if i] + args.batch_inputs
+	if len(paths) > 3:
+		parser.error("too many video arguments")
+	output = paths.pop() if len(paths) > 1 else "-"
+	if output == "-":
+		if args.format is None:
+			parser.error("the format is required for outputting to STDOUT")
+		output = sys.stdout.buffer
+
+	inputs = []
+	for path in paths or ["-"]:
+		if path == "-":
+			path = sys.stdin.buffer
+		inputs.append(open_video_frames(path, args.video_size))
+
+	first = next(inputs[0], None)
+	if first is None:
+		parser.error("no input video frames")
+	inputs[0] = itertools.chain([first], inputs[0])
+
+	if args.fps:
+		fps = tuple(int(i) for i in (args.fps + "/1").split("/")[:2])
+	else:
+		fps = first.info.get("fps", (25, 1))
+
+	pipeline = _create_pipeline(args)
+	try:
+		pipeline.save_video(pipeline.process_video(*inputs), output, fps)
+	except ValueError as e:
+		print(e, file=sys.stderr)
+		sys.exit(1)
+
+_serve_parser = None
+_serve_pipelines = {}
+_serve_align_cache = None
+
+def _parse_request_arguments(query):
+	# The CLI arguments of the options in a request query, such as
+	# "a&resize=400+0&format=png" for "-a --resize 400 0 --format png".
+	global _serve_parser
+	try:
+		from urllib.parse import parse_qsl
+	except ImportError:
+		from urlparse import parse_qsl
+
+	argv = []
+	for key, value in parse_qsl(query, keep_blank_values=True):
+		argv.append(("-" if len(key) == 1 else "--") + key)
+		argv.extend(value.split())
+
+	if _serve_parser is None:
+		parser = _create_argument_parser()
+		def error(message):
+			raise ValueError(message)
+		parser.error = error
+		_serve_parser = parser
+	try:
+		args = _serve_parser.parse_args(argv)
+	except SystemExit:
+		raise ValueError("invalid options")
+	if (args.image_in or args.batch_inputs or args.batch or args.video
+			or args.raw_size or args.outputs
+			or getattr(args, "align_cache", None)):
+		raise ValueError("only options can be given")
+	return argv, args
+
+def _convert_request(query, body, content_type):
+	# Convert the images of a request body, being an MPO or a
+	# multipart/form-data of two images, with the options of its query.
+	# Returns the output image data and its MIME type.
+	import email
+
+	argv, args = _parse_request_arguments(query)
+	image_format = args.format or ("gif" if args.wiggle else None)
+	if image_format is None:
+		raise ValueError("the format option is required")
+	image_format = Image.registered_extensions().get(
+		"." + image_format.lower(), image_format.upper())
+
+	key = tuple(argv)
+	pipeline = _serve_pipelines.get(key)
+	if pipeline is None:
+		pipeline = _create_pipeline(args)
+		pipeline.format = image_format
+		pipeline.align_cache = _serve_align_cache
+		if len(_serve_pipelines) >= 32:
+			_serve_pipelines.clear()
+		_serve_pipelines[key] = pipeline
+
+	images = None
+	if content_type.startswith("multipart/"):
+		parse = getattr(email, "message_from_bytes",
+			email.message_from_string)
+		message = parse(b"Content-Type: " + content_type.encode("latin-1")
+			+ b"\r\n\r\n" + body)
+		parts = [part.get_payload(decode=True) for part in message.walk()
+			if not part.is_multipart()]
+		if len(parts) >= 2:
+			images = [Image.open(io.BytesIO(part)) for part in parts[:2]]
+		elif parts:
+			body = parts[0]
+	if images is None:
+		images = open_frames(io.BytesIO(body))
+
+	output = io.BytesIO()
+	if args.tile_height:
+		size, strips = pipeline.compose_strips(pipeline.preprocess(
+			itertools.islice(images, 2)), args.tile_height)
+		pipeline.save_strips(size, strips, output)
+	else:
+		pipeline.save(pipeline.process(images), output)
 
-		images = transform(images, matrices, not args.expand)
+	return (output.getvalue(),
+		Image.MIME.get(image_format, "application/octet-stream"))
 
-	for i in range(len(images)):
-		if any(args.crop):
-			images[i] = crop(images[i], args.crop)
+def _create_server(address, jobs=0):
+	import os
+	import stat
+	from multiprocessing.pool import ThreadPool
+	try:
+		from http.server import HTTPServer, BaseHTTPRequestHandler
+		from socketserver import ThreadingMixIn
+	except ImportError:
+		from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+		from SocketServer import ThreadingMixIn
 
-		if any(args.resize):
-			images[i] = resize(images[i], args.resize, args.offset)
+	pool = ThreadPool(jobs or None)
 
-	do_save = True
-	if args.anaglyph:
-		if args.luma_coding == "rgb":
-			luma_coding = ANAGLYPH_LUMA_RGB
-		elif args.luma_coding == "rec601":
-			luma_coding = ANAGLYPH_LUMA_REC601
-		elif args.luma_coding == "rec709":
-			luma_coding = ANAGLYPH_LUMA_REC709
-		images = [create_anaglyph(
-			images, args.anaglyph_method, args.color_scheme, luma_coding)]
-	elif args.interlaced_horizontal:
-		images = [create_patterned_image(
-			images, PATTERN_INTERLACED_H, args.pattern_width, not args.odd)]
-	elif args.interlaced_vertical:
-		images = [create_patterned_image(
-			images, PATTERN_INTERLACED_V, args.pattern_width, not args.odd)]
-	elif args.checkerboard:
-		images = [create_patterned_image(
-			images, PATTERN_CHECKERBOARD, args.pattern_width, not args.odd)]
-	elif args.wiggle:
-		do_save = False
+	class RequestHandler(BaseHTTPRequestHandler):
+		def do_GET(self):
+			self._respond(200, b"StereoscoPy\n", "text/plain")
+
+		def do_POST(self):
+			body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+			query = self.path.partition("?")[2]
+			try:
+				data, content_type = pool.apply(_convert_request,
+					(query, body, self.headers.get("Content-Type", "")))
+			except (ValueError, SyntaxError, IOError, OSError) as e:
+				self._respond(400, (str(e) or type(e).__name__).encode(
+					"utf-8") + b"\n", "text/plain")
+				return
+			except Exception as e:
+				self._respond(500, (str(e) or type(e).__name__).encode(
+					"utf-8") + b"\n", "text/plain")
+				return
+			self._respond(200, data, content_type)
+
+		def _respond(self, status, data, content_type):
+			self.send_response(status)
+			self.send_header("Content-Type", content_type)
+			self.send_header("Content-Length", str(len(data)))
+			self.end_headers()
+			self.wfile.write(data)
+
+		def address_string(self):
+			return self.client_address[0] if self.client_address else "-"
+
+	if isinstance(address, str):
+		try:
+			from socketserver import UnixStreamServer
+		except ImportError:
+			from SocketServer import UnixStreamServer
+
+		if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+			os.remove(address)
+
+		class Server(ThreadingMixIn, UnixStreamServer):
+			daemon_threads = True
 	else:
-		if not (args.cross_eye or args.parallel or
-			args.over_under or args.under_over):
-			args.cross_eye = True
+		class Server(ThreadingMixIn, HTTPServer):
+			daemon_threads = True
 
-		is_horizontal = args.cross_eye or args.parallel
+	server = Server(address, RequestHandler)
+	server.pool = pool
+	return server
 
-		if args.squash:
-			for i in range(len(images)):
-				images[i] = squash(images[i], is_horizontal)
+def _main_serve(argv):
+	import sys
+	import argparse
 
-		if args.cross_eye or args.under_over:
-			images.reverse()
+	parser = argparse.ArgumentParser(prog="stereoscopy serve",
+		description="Serve the conversion of images over HTTP on a local "
+			"address or a Unix socket. POST an MPO, or a multipart/form-data "
+			"of the left and right images, with the options of the "
+			"command-line interface as the query, such as "
+			"\"/?a&resize=400+0&format=jpg\" for \"-a --resize 400 0 "
+			"--format jpg\". The output image is returned.")
+	parser.add_argument("--host",
+		dest='host', type=str, default="127.0.0.1",
+		help="set the address to listen on [default: %(default)s]")
+	parser.add_argument("--port",
+		dest='port', type=int, default=8080,
+		help="set the port to listen on [default: %(default)s]")
+	parser.add_argument("--socket",
+		dest='socket', metavar="PATH", type=str,
+		help="listen on a Unix socket instead")
+	parser.add_argument("-j", "--jobs",
+		dest='jobs', metavar="N", type=int, default=0,
+		help="set the number of threads converting requests in parallel, "
+			"0 for the number of CPUs [default: %(default)s]")
+	parser.add_argument("--align-cache",
+		dest='align_cache', metavar="DIR", type=str,
+		help="cache the found auto alignments of requests in a directory, "
+			"which requests cannot set themselves")
+	args = parser.parse_args(argv)
+
+	global _serve_align_cache
+	if args.align_cache:
+		_serve_align_cache = AlignmentCache(args.align_cache)
+
+	address = args.socket or (args.host, args.port)
+	server = _create_server(address, args.jobs)
+	print("Serving on {}".format(args.socket or "http://{}:{}/".format(
+		args.host, server.server_address[1])), file=sys.stderr)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		server.pool.terminate()
 
-		if args.image_output2 is None:
-			images = [create_side_by_side_image(
-				images, is_horizontal, args.divider)]
+def _main():
+	import sys
+	import time
 
-	for i in range(len(images)):
-		if args.border:
-			images[i] = ImageOps.expand(images[i], args.border)
+	if sys.argv[1:2] == ["serve"]:
+		_main_serve(sys.argv[2:])
+		return
 
-		if args.bg_color and images[i].mode == "RGBA":
-			background_image = Image.new(
-				"RGBA", images[i].size, tuple(args.bg_color))
-			images[i] = Image.alpha_composite(background_image, images[i])
+	parser = _create_argument_parser()
+	args = parser.parse_args()
 
-		if do_save:
-			try:
-				path = (image_output, args.image_output2)[i]
-			except:
-				break
-			try:
-				images[i].save(path,
-					format=args.format, quality=args.quality, optimize=True)
-			except OSError:
-				images[i].convert("RGB").save(path,
-					format=args.format, quality=args.quality, optimize=True)
+	if args.batch:
+		_main_batch(parser, args)
+		return
+
+	if args.video:
+		_main_video(parser, args)
+		return
 
-	if args.wiggle:
-		save_as_wiggle_gif_image(image_output, images, args.duration)
+	if args.outputs:
+		_main_outputs(parser, args)
+		return
+
+	if args.batch_inputs:
+		parser.error("unrecognized arguments: " + " ".join(args.batch_inputs))
+
+	if args.image_output:
+		image_output = args.image_output
+	else:
+		if args.format is None and not args.wiggle:
+			print("Either specify the output file name or the format "
+				"to be used for outputting to STDOUT.", file=sys.stderr)
+			exit()
+		image_output = sys.stdout.buffer
+		if not image_output.seekable():
+			image_output = _ChunkedWriter(image_output)
+
+	# Formats written the same by strips are streamed to STDOUT
+	tile_height = args.tile_height
+	if (not tile_height and not args.image_output and not args.wiggle
+			and args.format.lower() in _STRIP_FORMATS):
+		tile_height = 256
+
+	pipeline = _create_pipeline(args, args.image_output2 is not None)
+	if args.verbose:
+		pipeline.timings = {}
+	start = time.time()
+	images = _open_images(args.image_in, args.image_in2,
+		args.raw_size, args.raw_mode)
+	try:
+		if tile_height:
+			# The strips are composed while encoding
+			images = pipeline.preprocess(itertools.islice(images, 2))
+			processed = time.time()
+			size, strips = pipeline.compose_strips(images, tile_height)
+			pipeline.save_strips(size, strips, image_output)
+		else:
+			images = pipeline.process(images)
+			processed = time.time()
+			pipeline.save(images, image_output, args.image_output2)
+	except ValueError as e:
+		print(e, file=sys.stderr)
+		exit()
+	finally:
+		if not args.image_output:
+			image_output.flush()
+
+	if args.verbose:
+		end = time.time()
+		decode = pipeline.timings.get("decode", 0)
+		for name, seconds in (("decode", decode),
+				("process", processed - start - decode),
+				("encode", end - processed), ("total", end - start)):
+			print("{:<8} {:.3f} s".format(name, seconds), file=sys.stderr)
 
 if __name__ == "__main__":
 	_main()
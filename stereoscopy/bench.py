@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#	StereoscoPy, stereoscopic 3D image creator
+#
+#	Copyright (C) 2016-2024 2sh <contact@2sh.me>
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+import stereoscopy
+
+_HEAVY_MODULES = ("numpy", "cv2")
+
+# Sizes of the synthetic images of 1, 12 and 48 megapixels
+SIZES = {
+	1: (1224, 816),
+	12: (4240, 2832),
+	48: (8480, 5664)
+}
+
+_ANAGLYPH_METHODS = ("gray", "color", "half-color", "wimmer", "dubois")
+
+# The name, input image mode and CLI options of the cases of which the
+# peak memory of a CLI conversion is measured
+_MEMORY_CASES = (
+	("grayscale --ih", "L", ["--ih"]),
+	("grayscale -x --div --border --bg", "L", ["-x", "--div", "20",
+		"--border", "10", "--bg", "255", "255", "255", "255"]),
+	("grayscale -x --border --bg translucent", "L",
+		["-x", "--border", "10", "--bg", "50", "50", "50", "128"]),
+	("RGB -x --div --bg", "RGB",
+		["-x", "--div", "20", "--bg", "255", "255", "255", "255"]),
+	("palette --cb", "P", ["--cb"])
+)
+
+# Run the CLI and print its peak memory in megabytes, from /proc as the
+# peak of a process of its own, or from getrusage elsewhere
+_CLI_MEMORY_CODE = """
+import sys
+sys.argv[0] = "stereoscopy"
+try:
+	from stereoscopy import _main
+	_main()
+finally:
+	peak = None
+	try:
+		with open("/proc/self/status") as f:
+			for line in f:
+				if line.startswith("VmHWM:"):
+					peak = int(line.split()[1]) / 1024
+	except (IOError, OSError):
+		import resource
+		peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (
+			1024 * 1024 if sys.platform == "darwin" else 1024)
+	print(round(peak, 1))
+"""
+
+def _get_package_path():
+	return os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _get_python_env(path=None):
+	# The environment running Python with the package at a path, with the
+	# bytecode written and used as with an installed package
+	env = dict(os.environ)
+	env.pop("PYTHONDONTWRITEBYTECODE", None)
+	env["PYTHONPATH"] = os.pathsep.join(
+		[path or _get_package_path()]
+		+ [p for p in [env.get("PYTHONPATH")] if p])
+	return env
+
+def _run_python(arguments):
+	# Run Python with the package being benchmarked.
+	process = subprocess.Popen([sys.executable] + arguments,
+		env=_get_python_env(),
+		stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	stdout, stderr = process.communicate()
+	if process.returncode:
+		raise RuntimeError(stderr.decode("utf-8", "replace"))
+	return stdout.decode("utf-8"), stderr.decode("utf-8")
+
+def measure_startup(repeat=5):
+	"""Measure the startup time of importing the package and of the CLI.
+
+	The import time is taken from *python -X importtime* and the CLI time
+	is the wall time of *--help*, both the lowest of several runs after
+	a run compiling the bytecode.
+
+	Args:
+		repeat: The amount of runs.
+
+	Returns:
+		A dict of the import and CLI times in milliseconds and the heavy
+		optional modules loaded by a plain import.
+	"""
+	_run_python(["-c", "import stereoscopy"])
+
+	import_times = []
+	for _ in range(repeat):
+		_, stderr = _run_python(["-X", "importtime", "-c",
+			"import stereoscopy"])
+		for line in stderr.splitlines():
+			fields = line.split("|")
+			if len(fields) == 3 and fields[2].strip() == "stereoscopy":
+				import_times.append(int(fields[1]) / 1000)
+
+	cli_times = []
+	for _ in range(repeat):
+		start = time.time()
+		_run_python(["-m", "stereoscopy", "--help"])
+		cli_times.append((time.time() - start) * 1000)
+
+	stdout, _ = _run_python(["-c", "import sys, stereoscopy; "
+		"print(' '.join(m for m in {!r} if m in sys.modules))".format(
+		_HEAVY_MODULES)])
+
+	return {
+		"import_ms": round(min(import_times), 1),
+		"cli_help_ms": round(min(cli_times), 1),
+		"heavy_modules": stdout.split()
+	}
+
+def create_stereo_pair(size):
+	"""Create a synthetic stereo pair.
+
+	The left image is made of gradients and noise, and the right image is
+	the left image shifted and slightly rotated.
+
+	Args:
+		size: The width and height of the images.
+
+	Returns:
+		The left and right PIL images.
+	"""
+	bands = [Image.linear_gradient("L"), Image.radial_gradient("L"),
+		Image.linear_gradient("L").rotate(90)]
+	bands = [band.resize(size, Image.BILINEAR) for band in bands]
+	noise = Image.effect_noise(size, 32)
+	left = Image.merge("RGB", [Image.blend(band, noise, 0.3)
+		for band in bands])
+
+	matrix = stereoscopy.xy_and_angle_to_matrix(
+		(size[0] // 100, size[1] // 200), 0.5, size)
+	right = left.transform(size, Image.AFFINE,
+		data=[value for row in matrix[:2] for value in row],
+		resample=Image.BILINEAR)
+	return [left, right]
+
+def _reset_peak_memory():
+	# Reset the peak resident memory of the process, which is only
+	# possible on Linux, and return whether it was.
+	try:
+		with open("/proc/self/clear_refs", "w") as f:
+			f.write("5")
+		return True
+	except (IOError, OSError):
+		return False
+
+def _get_memory(field="VmHWM"):
+	# The peak (VmHWM) or current (VmRSS) resident memory of the process
+	# in megabytes
+	try:
+		with open("/proc/self/status") as f:
+			for line in f:
+				if line.startswith(field + ":"):
+					return int(line.split()[1]) / 1024
+	except (IOError, OSError):
+		pass
+	if field != "VmHWM":
+		return None
+	import resource
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+def measure(function, megapixels, repeat=3):
+	"""Measure the wall time, throughput and peak memory of a function.
+
+	Args:
+		function: The function to call without arguments.
+		megapixels: The megapixels processed by a call, for the
+			throughput.
+		repeat: The amount of calls, of which the fastest is taken.
+
+	Returns:
+		A dict of the time in seconds, the throughput in megapixels per
+		second, the peak memory and its increase over the memory in use
+		before in megabytes. The peak memory is the peak of the whole
+		process if it cannot be reset.
+	"""
+	memory = _get_memory("VmRSS")
+	is_reset = _reset_peak_memory()
+	times = []
+	for _ in range(repeat):
+		start = time.time()
+		function()
+		times.append(time.time() - start)
+	seconds = min(times)
+	peak_memory = _get_memory()
+	return {
+		"seconds": round(seconds, 4),
+		"mp_per_s": round(megapixels / seconds, 2) if seconds else None,
+		"peak_memory_mb": round(peak_memory, 1),
+		"memory_increase_mb": (round(peak_memory - memory, 1)
+			if is_reset and memory is not None else None),
+		"peak_memory_is_process_peak": not is_reset
+	}
+
+def _get_benchmarks(images):
+	# The name, parameters and function of each benchmark of a pair
+	left, right = images
+	size = left.size
+
+	for method in _ANAGLYPH_METHODS:
+		if method == "dubois":
+			color_schemes = sorted(stereoscopy.AnaglyphMethod._DUBOIS)
+		else:
+			color_schemes = sorted(stereoscopy.AnaglyphMethod._COLOR_SCHEMES)
+		for color_scheme in color_schemes:
+			yield ("create_anaglyph",
+				{"method": method, "color_scheme": color_scheme},
+				lambda method=method, color_scheme=color_scheme:
+					stereoscopy.create_anaglyph(images, method, color_scheme))
+
+	for name in sorted(stereoscopy._PATTERNS):
+		pattern = stereoscopy._PATTERNS[name]
+		yield ("create_patterned_image", {"pattern": name},
+			lambda pattern=pattern:
+				stereoscopy.create_patterned_image(images, pattern))
+
+	yield ("create_side_by_side_image", {},
+		lambda: stereoscopy.create_side_by_side_image(images))
+	yield ("squash", {}, lambda: stereoscopy.squash(left, True))
+	yield ("resize", {"size": [size[0] // 2, 0]},
+		lambda: stereoscopy.resize(left, (size[0] // 2, 0)))
+
+	matrices = [stereoscopy.xy_and_angle_to_matrix((-5, -3), 0.5, size),
+		stereoscopy.xy_and_angle_to_matrix((5, 3), -0.5, size)]
+	yield ("transform", {}, lambda: stereoscopy.transform(images, matrices))
+
+	if stereoscopy._HAS_CV2:
+		yield ("find_alignments", {},
+			lambda: stereoscopy.find_alignments(images))
+
+	yield ("save_as_wiggle_gif_image", {},
+		lambda: stereoscopy.save_as_wiggle_gif_image(io.BytesIO(), images))
+
+def run_benchmarks(sizes=(1, 12, 48), repeat=3, name_filter=None):
+	"""Run the benchmarks of the image functions on synthetic pairs.
+
+	Args:
+		sizes: The megapixels of the pairs, being keys of *SIZES*.
+		repeat: The amount of runs of each benchmark.
+		name_filter: Only run the benchmarks with names containing it.
+
+	Returns:
+		A list of dicts of the name, parameters, image size and
+		measurements of each benchmark.
+	"""
+	results = []
+	for megapixels in sizes:
+		size = SIZES[megapixels]
+		images = create_stereo_pair(size)
+		for name, parameters, function in _get_benchmarks(images):
+			if name_filter and name_filter not in name:
+				continue
+			result = {
+				"name": name,
+				"parameters": parameters,
+				"size": list(size),
+				"megapixels": round(size[0] * size[1] / 1000000, 2)
+			}
+			result.update(measure(function, result["megapixels"], repeat))
+			results.append(result)
+			print("{} {} {}MP: {}s".format(name, json.dumps(parameters),
+				megapixels, result["seconds"]), file=sys.stderr)
+	return results
+
+def measure_cli_memory(size=SIZES[12], package=None):
+	"""Measure the peak memory of CLI conversions of synthetic pairs.
+
+	Each case converts a pair saved as PNG images, or JPEG images for
+	RGB, into a JPEG image in a process of its own.
+
+	Args:
+		size: The width and height of the images.
+		package: The directory containing the package to run, such as a
+			checkout of an older version to compare with. If omitted,
+			the benchmarked package is run.
+
+	Returns:
+		A list of dicts of the name, options, image size, wall time in
+		seconds and peak resident memory in megabytes of each case.
+	"""
+	directory = tempfile.mkdtemp()
+	try:
+		pair = create_stereo_pair(size)
+		results = []
+		for name, mode, options in _MEMORY_CASES:
+			extension = ".jpg" if mode == "RGB" else ".png"
+			paths = []
+			for side, image in zip(("left", "right"), pair):
+				path = os.path.join(directory, side + extension)
+				if mode == "P":
+					image = image.quantize(256)
+				elif image.mode != mode:
+					image = image.convert(mode)
+				image.save(path)
+				paths.append(path)
+
+			start = time.time()
+			process = subprocess.Popen([sys.executable, "-c", _CLI_MEMORY_CODE]
+				+ options + paths + [os.path.join(directory, "out.jpg")],
+				env=_get_python_env(package), cwd=directory,
+				stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+			stdout, stderr = process.communicate()
+			seconds = time.time() - start
+			if process.returncode:
+				raise RuntimeError(stderr.decode("utf-8", "replace"))
+			peak_memory = float(stdout.decode("utf-8").split()[-1])
+
+			results.append({
+				"name": name,
+				"options": options,
+				"size": list(size),
+				"seconds": round(seconds, 3),
+				"peak_memory_mb": peak_memory
+			})
+			print("cli_memory {}: {} MB".format(name, peak_memory),
+				file=sys.stderr)
+		return results
+	finally:
+		shutil.rmtree(directory)
+
+def _get_environment():
+	environment = {
+		"python": sys.version.split()[0],
+		"pillow": getattr(Image, "__version__", None)
+	}
+	for module in _HEAVY_MODULES:
+		try:
+			environment[module] = __import__(module).__version__
+		except ImportError:
+			environment[module] = None
+	return environment
+
+def _main():
+	import argparse
+
+	parser = argparse.ArgumentParser(prog="python -m stereoscopy.bench",
+		description="Benchmark StereoscoPy and output the results as JSON")
+	parser.add_argument("--repeat",
+		dest='repeat', metavar="N", type=int, default=3,
+		help="set the amount of runs of each benchmark, of which the "
+			"fastest is taken [default: %(default)s]")
+	parser.add_argument("--sizes",
+		dest='sizes', metavar="MP", type=int, nargs='+',
+		choices=sorted(SIZES), default=sorted(SIZES),
+		help="set the megapixels of the synthetic image pairs: "
+			"1, 12, 48 [default: all]")
+	parser.add_argument("--filter",
+		dest='filter', metavar="NAME", type=str,
+		help="only run the benchmarks with names containing NAME, "
+			"such as create_anaglyph or startup")
+	parser.add_argument("-o", "--output",
+		dest='output', metavar="FILE", type=str,
+		help="write the JSON results to a file instead of STDOUT")
+	parser.add_argument("--package",
+		dest='package', metavar="PATH", type=str,
+		help="run the CLI of the package in a directory for the cli_memory "
+			"cases, such as a checkout of an older version to compare the "
+			"peak memory with")
+	parser.add_argument("--import-budget",
+		dest='import_budget', metavar="MS", type=float, default=100,
+		help="fail if importing the package takes longer or imports "
+			"numpy or OpenCV [default: %(default)s]")
+	args = parser.parse_args()
+
+	results = {"environment": _get_environment()}
+	if not args.filter or args.filter in "startup":
+		results["startup"] = measure_startup(args.repeat)
+	if not args.filter or args.filter in "cli_memory":
+		results["cli_memory"] = measure_cli_memory(package=args.package)
+	results["benchmarks"] = run_benchmarks(args.sizes, args.repeat,
+		args.filter)
+
+	output = json.dumps(results, indent=2, sort_keys=True)
+	if args.output:
+		with open(args.output, "w") as f:
+			f.write(output + "\n")
+	else:
+		print(output)
+
+	startup = results.get("startup")
+	if startup and startup["import_ms"] > args.import_budget:
+		print("The import time of {} ms exceeds the budget of {} ms".format(
+			startup["import_ms"], args.import_budget), file=sys.stderr)
+		sys.exit(1)
+	if startup and startup["heavy_modules"]:
+		print("Importing the package imports " +
+			", ".join(startup["heavy_modules"]), file=sys.stderr)
+		sys.exit(1)
+
+if __name__ == "__main__":
+	_main()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division, print_function
+
+import os
+
+import pytest
+from PIL import Image
+
+import stereoscopy
+
+_EXAMPLE_IMAGES = os.path.join(os.path.dirname(os.path.dirname(
+	os.path.abspath(__file__))), "example_images")
+
+def _open_example_images():
+	return [Image.open(os.path.join(_EXAMPLE_IMAGES, name)).convert("RGB")
+		for name in ("left.jpg", "right.jpg")]
+
+def _process_image_wimmer_per_pixel(image):
+	# The former per-pixel processing of the red-cyan Wimmer method
+	image = image.copy()
+	pixels = image.load()
+	for y in range(image.height):
+		for x in range(image.width):
+			c = list(pixels[x, y])
+
+			if c[0] > c[1] and c[0] > c[1]:
+				c[1] = int(round(c[0]*0.3+c[1]*0.7))
+				c[2] = int(round(c[0]*0.3+c[2]*0.7))
+
+			pixels[x, y] = tuple(c)
+	return image
+
+def _get_differences(image, expected):
+	return [abs(a - b) for pixel, expected_pixel in zip(image.getdata(),
+		expected.getdata()) for a, b in zip(pixel, expected_pixel)]
+
+@pytest.fixture(scope="module")
+def wimmer_images():
+	images = _open_example_images()
+	return images, [_process_image_wimmer_per_pixel(image)
+		for image in images]
+
+def test_wimmer_numpy_is_exact(wimmer_images):
+	if not stereoscopy._import_numpy():
+		pytest.skip("numpy is not installed")
+	images, expected = wimmer_images
+	method = stereoscopy.AnaglyphMethod.wimmer()
+	for image, expected_image in zip(images, expected):
+		output = method._process_image_wimmer_numpy(image)
+		assert output.mode == expected_image.mode
+		assert output.tobytes() == expected_image.tobytes()
+
+def test_wimmer_pillow_is_within_one_level(wimmer_images):
+	images, expected = wimmer_images
+	method = stereoscopy.AnaglyphMethod.wimmer()
+	for image, expected_image in zip(images, expected):
+		output = method._process_image_wimmer_pillow(image)
+		assert output.mode == expected_image.mode
+		assert max(_get_differences(output, expected_image)) <= 1
+
+def test_wimmer_keeps_alpha(wimmer_images):
+	images, expected = wimmer_images
+	image = images[0].convert("RGBA")
+	image.putalpha(128)
+	method = stereoscopy.AnaglyphMethod.wimmer()
+	output = method._process_images_wimmer([image, image])[0]
+	assert output.mode == "RGBA"
+	assert output.getchannel("A").getextrema() == (128, 128)
+	assert max(_get_differences(output.convert("RGB"), expected[0])) <= 1
+
+class _HalfAnaglyphMethod(stereoscopy.AnaglyphMethod):
+	def process_expression(self, band_i, expression):
+		return "(" + expression + ")*0.5"
+
+def _assert_half_of(image, expected):
+	assert image.mode == expected.mode
+	assert max(abs(a - b//2) for pixel, expected_pixel in zip(
+		image.getdata(), expected.getdata())
+		for a, b in zip(pixel, expected_pixel)) <= 1
+
+def test_process_expression_instance_override(wimmer_images):
+	images = [image.resize((120, 80)) for image in wimmer_images[0]]
+	expected = stereoscopy.AnaglyphMethod.color().createAnaglyph(images)
+	method = stereoscopy.AnaglyphMethod.color()
+	method.process_expression = lambda band_i, expression: (
+		"(" + expression + ")*0.5")
+	_assert_half_of(method.createAnaglyph(images), expected)
+
+def test_process_expression_subclass_override(wimmer_images):
+	images = [image.resize((120, 80)) for image in wimmer_images[0]]
+	expected = stereoscopy.AnaglyphMethod.color().createAnaglyph(images)
+	method = _HalfAnaglyphMethod(
+		stereoscopy.AnaglyphMethod.color().matrices)
+	_assert_half_of(method.createAnaglyph(images), expected)
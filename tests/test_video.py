@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division, print_function
+
+import io
+import os
+import random
+
+import pytest
+from PIL import Image
+
+import stereoscopy
+
+_EXAMPLE_IMAGES = os.path.join(os.path.dirname(os.path.dirname(
+	os.path.abspath(__file__))), "example_images")
+
+def _create_jittered_frames(count, size=(400, 265), seed=3):
+	# Pairs of the same example images with the right image moved by up
+	# to 1.5 pixels in each frame
+	left, right = [Image.open(os.path.join(_EXAMPLE_IMAGES, name)).resize(
+		size, Image.LANCZOS) for name in ("left.jpg", "right.jpg")]
+	jitter = random.Random(seed)
+	frames = []
+	for _ in range(count):
+		data = (1, 0, jitter.uniform(-1.5, 1.5),
+			0, 1, jitter.uniform(-1.5, 1.5))
+		frames.append((left.copy(), right.transform(size, Image.AFFINE,
+			data, Image.BICUBIC)))
+	return frames
+
+@pytest.mark.parametrize("single_resample", [False, True])
+def test_align_keyframes_keep_the_output_size(single_resample):
+	if not stereoscopy._HAS_CV2:
+		pytest.skip("OpenCV and numpy are not installed")
+	frames = _create_jittered_frames(8)
+	pipeline = stereoscopy.Pipeline("anaglyph", auto_align=True,
+		align_keyframes=3, single_resample=single_resample)
+	outputs = list(pipeline.process_video([left for left, _ in frames],
+		[right for _, right in frames]))
+	assert len(outputs) == len(frames)
+	assert len(set(output.size for output in outputs)) == 1
+
+	output = io.BytesIO()
+	pipeline.format = "y4m"
+	pipeline.save_video(outputs, output)
+	output.seek(0)
+	assert len(list(stereoscopy.open_video_frames(output))) == len(frames)